@@ -1,13 +1,16 @@
 from utils import *
 from tools import *
 from inference import *
+from routing import route_query, route_stats, json_validator
 
 class DevelopmentReviewAgent:
-    def __init__(self, model="gpt-4o-mini", notes=None, openai_api_key=None):
+    def __init__(self, model="gpt-4o-mini", notes=None, openai_api_key=None, cascade=None):
         if notes is None: self.notes = []
         else: self.notes = notes
         self.model = model
         self.openai_api_key = openai_api_key
+        # Models tried in order until one returns parseable JSON, e.g. ["gpt-4o-mini", "gpt-4o"]
+        self.cascade = cascade
 
     def review_code(self, project_plan, codebase):
         reviewer_prompt = """
@@ -23,13 +26,15 @@ class DevelopmentReviewAgent:
         - "Scalability": Rate the scalability of the architecture on a scale of 1 to 10.
         - "Decision": Either "Accept" or "Needs Improvement".
         """
-        review = query_model(
-            model_str=self.model,
+        review, _ = route_query(
+            self.cascade or [self.model],
             system_prompt=reviewer_prompt,
             openai_api_key=self.openai_api_key,
-            prompt=f"Project Plan: {project_plan}\n\nCodebase: {codebase}"
+            prompt=f"Project Plan: {project_plan}\n\nCodebase: {codebase}",
+            validator=json_validator,
+            route="review_code"
         )
-        return extract_json_between_markers(review)
+        return review
 
 class SoftwareEngineerAgent:
     def __init__(self, model="gpt-4o-mini", notes=None, max_steps=55, openai_api_key=None):
@@ -38,25 +43,42 @@ class SoftwareEngineerAgent:
         self.model = model
         self.openai_api_key = openai_api_key
 
-    def develop_feature(self, project_requirements, feature_spec):
+    def _develop_feature_request(self, project_requirements, feature_spec):
         development_prompt = """
         You are an AI-powered software engineer responsible for implementing new features.
         Given the project requirements and feature specifications, generate high-quality Python code.
         Ensure the implementation follows best practices in modularity, documentation, and performance.
         """
-        code = query_model(
+        # The requirements (project description and reference documents) are the same for every
+        # subtask, so they go into the provider-cached prefix ahead of the per-subtask specification
+        return dict(
             model_str=self.model,
             system_prompt=development_prompt,
             openai_api_key=self.openai_api_key,
-            prompt=f"Project Requirements: {project_requirements}\n\nFeature Specification: {feature_spec}"
+            context=f"Project Requirements: {project_requirements}",
+            prompt=f"Feature Specification: {feature_spec}"
         )
+
+    def develop_feature(self, project_requirements, feature_spec, stream=False):
+        request = self._develop_feature_request(project_requirements, feature_spec)
+        if stream:
+            return strip_stream(query_model(**request, stream=True))
+        code = query_model(**request)
+        return code.strip()
+
+    async def adevelop_feature(self, project_requirements, feature_spec):
+        code = await aquery_model(**self._develop_feature_request(project_requirements, feature_spec))
         return code.strip()
     
     # New unified interface method:
-    def perform_task(self, project_name, subtask):
+    def perform_task(self, project_name, subtask, stream=False):
         # In this context, assume `project_name` acts as the project requirements 
         # and `subtask` contains the feature specification.
-        return self.develop_feature(project_name, subtask)
+        # With `stream=True` an iterator of output chunks is returned instead of a string.
+        return self.develop_feature(project_name, subtask, stream=stream)
+
+    async def aperform_task(self, project_name, subtask):
+        return await self.adevelop_feature(project_name, subtask)
 
 class DevOpsEngineerAgent:
     def __init__(self, model="gpt-4o-mini", notes=None, max_steps=55, openai_api_key=None):
@@ -65,49 +87,82 @@ class DevOpsEngineerAgent:
         self.model = model
         self.openai_api_key = openai_api_key
 
-    def deploy_application(self, infrastructure_config, deployment_strategy):
+    def _deploy_application_request(self, infrastructure_config, deployment_strategy):
         devops_prompt = """
         You are an AI-powered DevOps engineer responsible for automating deployment pipelines.
         Given the infrastructure configuration and deployment strategy, generate a deployment script.
         Ensure the script follows best practices for CI/CD, security, and scalability.
         """
-        deployment_script = query_model(
+        return dict(
             model_str=self.model,
             system_prompt=devops_prompt,
             openai_api_key=self.openai_api_key,
             prompt=f"Infrastructure Configuration: {infrastructure_config}\n\nDeployment Strategy: {deployment_strategy}"
         )
+
+    def deploy_application(self, infrastructure_config, deployment_strategy, stream=False):
+        request = self._deploy_application_request(infrastructure_config, deployment_strategy)
+        if stream:
+            return strip_stream(query_model(**request, stream=True))
+        deployment_script = query_model(**request)
         return deployment_script.strip()
 
-    def monitor_systems(self, monitoring_config):
+    async def adeploy_application(self, infrastructure_config, deployment_strategy):
+        deployment_script = await aquery_model(**self._deploy_application_request(infrastructure_config, deployment_strategy))
+        return deployment_script.strip()
+
+    def _monitor_systems_request(self, monitoring_config):
         devops_prompt = """
         You are an AI-powered DevOps engineer responsible for monitoring system performance and health.
         Given the monitoring configuration, generate a monitoring setup script.
         Ensure the setup follows best practices for observability, alerting, and scalability.
         """
-        monitoring_script = query_model(
+        return dict(
             model_str=self.model,
             system_prompt=devops_prompt,
             openai_api_key=self.openai_api_key,
             prompt=f"Monitoring Configuration: {monitoring_config}"
         )
+
+    def monitor_systems(self, monitoring_config, stream=False):
+        request = self._monitor_systems_request(monitoring_config)
+        if stream:
+            return strip_stream(query_model(**request, stream=True))
+        monitoring_script = query_model(**request)
+        return monitoring_script.strip()
+
+    async def amonitor_systems(self, monitoring_config):
+        monitoring_script = await aquery_model(**self._monitor_systems_request(monitoring_config))
         return monitoring_script.strip()
 
-    def manage_infrastructure(self, infrastructure_spec):
+    def _manage_infrastructure_request(self, infrastructure_spec):
         devops_prompt = """
         You are an AI-powered DevOps engineer responsible for managing infrastructure as code.
         Given the infrastructure specifications, generate the necessary scripts or configurations.
         Ensure the configurations follow best practices for scalability, security, and maintainability.
         """
-        infrastructure_script = query_model(
+        return dict(
             model_str=self.model,
             system_prompt=devops_prompt,
             openai_api_key=self.openai_api_key,
             prompt=f"Infrastructure Specification: {infrastructure_spec}"
         )
+
+    def manage_infrastructure(self, infrastructure_spec, stream=False):
+        request = self._manage_infrastructure_request(infrastructure_spec)
+        if stream:
+            return strip_stream(query_model(**request, stream=True))
+        infrastructure_script = query_model(**request)
+        return infrastructure_script.strip()
+
+    async def amanage_infrastructure(self, infrastructure_spec):
+        infrastructure_script = await aquery_model(**self._manage_infrastructure_request(infrastructure_spec))
         return infrastructure_script.strip()
 
-    def perform_task(self, project_name, subtask):
+    def _resolve_task(self, subtask):
+        """
+        Map a subtask dictionary to (method name, arguments) of the matching DevOps action.
+        """
     # Check if subtask is a dictionary
         if not isinstance(subtask, dict):
             raise TypeError(f"Expected subtask to be a dictionary, but got {type(subtask).__name__}")
@@ -119,16 +174,24 @@ class DevOpsEngineerAgent:
         if task_type == 'deploy_application':
             infrastructure_config = task_details.get('infrastructure_config')
             deployment_strategy = task_details.get('deployment_strategy')
-            return self.deploy_application(infrastructure_config, deployment_strategy)
+            return "deploy_application", (infrastructure_config, deployment_strategy)
         elif task_type == 'monitor_systems':
             monitoring_config = task_details.get('monitoring_config')
-            return self.monitor_systems(monitoring_config)
+            return "monitor_systems", (monitoring_config,)
         elif task_type == 'manage_infrastructure':
             infrastructure_spec = task_details.get('infrastructure_spec')
-            return self.manage_infrastructure(infrastructure_spec)
+            return "manage_infrastructure", (infrastructure_spec,)
         else:
             raise ValueError(f"Unknown task type: {task_type}")
 
+    def perform_task(self, project_name, subtask, stream=False):
+        method, args = self._resolve_task(subtask)
+        return getattr(self, method)(*args, stream=stream)
+
+    async def aperform_task(self, project_name, subtask):
+        method, args = self._resolve_task(subtask)
+        return await getattr(self, f"a{method}")(*args)
+
 
 class QAEngineerAgent:
     def __init__(self, model="gpt-4o-mini", notes=None, max_steps=55, openai_api_key=None):
@@ -137,22 +200,35 @@ class QAEngineerAgent:
         self.model = model
         self.openai_api_key = openai_api_key
 
-    def generate_tests(self, feature_code):
+    def _generate_tests_request(self, feature_code):
         qa_prompt = """
         You are an AI-powered QA engineer responsible for writing unit and integration tests.
         Given the feature implementation, generate a comprehensive set of tests to ensure reliability.
         Ensure tests cover edge cases and follow best testing practices.
         """
-        test_cases = query_model(
+        return dict(
             model_str=self.model,
             system_prompt=qa_prompt,
             openai_api_key=self.openai_api_key,
             prompt=f"Feature Code:\n{feature_code}"
         )
+
+    def generate_tests(self, feature_code, stream=False):
+        request = self._generate_tests_request(feature_code)
+        if stream:
+            return strip_stream(query_model(**request, stream=True))
+        test_cases = query_model(**request)
+        return test_cases.strip()
+
+    async def agenerate_tests(self, feature_code):
+        test_cases = await aquery_model(**self._generate_tests_request(feature_code))
         return test_cases.strip()
     
     # New method to standardize the interface
-    def perform_task(self, project_name, subtask):
+    def perform_task(self, project_name, subtask, stream=False):
         # Here, subtask might be the feature code for which tests are needed.
         # Optionally, you could use project_name for logging or additional context.
-        return self.generate_tests(subtask)
+        return self.generate_tests(subtask, stream=stream)
+
+    async def aperform_task(self, project_name, subtask):
+        return await self.agenerate_tests(subtask)
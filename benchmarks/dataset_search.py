@@ -0,0 +1,73 @@
+"""
+Micro-benchmark: DatasetSearcher.search_many versus looping over DatasetSearcher.search.
+
+Usage:
+    python benchmarks/dataset_search.py --queries 50 --top-n 10
+    python benchmarks/dataset_search.py --synthetic 20000
+
+By default the persistent dataset index is used (built on first use). With --synthetic N
+a temporary index over N generated descriptions is built instead, so the benchmark runs offline.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools import DatasetSearcher, DatasetIndex
+
+WORDS = ("image text audio speech translation vision medical legal code math question answering "
+         "summarization sentiment classification detection segmentation tabular time series graph "
+         "recommendation reinforcement dialogue retrieval multilingual benchmark instruction").split()
+
+
+def synthetic_searcher(size, seed=0):
+    rng = random.Random(seed)
+    records = [{"id": f"synthetic-{i}", "description": " ".join(rng.choices(WORDS, k=12)),
+                "likes": rng.randint(0, 100), "downloads": rng.randint(0, 10000)} for i in range(size)]
+    path = os.path.join(tempfile.mkdtemp(prefix="dataset-bench-"), "index")
+    DatasetIndex.build(path, records, "synthetic", {"size": size, "seed": seed})
+    return DatasetSearcher(index=DatasetIndex(path))
+
+
+def time_call(fn, repeat):
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Batched dataset search benchmark")
+    parser.add_argument('--queries', type=int, default=50, help='Number of queries per batch.')
+    parser.add_argument('--top-n', type=int, default=10, help='Results per query.')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed repetitions (median is reported).')
+    parser.add_argument('--synthetic', type=int, default=None, help='Benchmark a synthetic index of this size.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    searcher = synthetic_searcher(args.synthetic) if args.synthetic else DatasetSearcher()
+    rng = random.Random(1)
+    queries = [" ".join(rng.choices(WORDS, k=4)) for _ in range(args.queries)]
+
+    # Warm up the vectorizer and page in the index before timing
+    searcher.search_many(queries[:1], args.top_n)
+    looped = time_call(lambda: [searcher.search(q, args.top_n) for q in queries], args.repeat)
+    batched = time_call(lambda: searcher.search_many(queries, args.top_n), args.repeat)
+
+    looped_ids = [[r.get("id") for r in searcher.search(q, args.top_n)] for q in queries]
+    batched_ids = [[r.get("id") for r, _ in hits] for hits in searcher.search_many(queries, args.top_n)]
+    agreement = statistics.mean(len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(looped_ids, batched_ids))
+
+    print(f"{len(searcher.records)} datasets, {len(queries)} queries, top {args.top_n}")
+    print(f"loop over search(): {looped * 1000:.2f} ms")
+    print(f"search_many():      {batched * 1000:.2f} ms  ({looped / batched:.1f}x faster)")
+    print(f"result agreement:   {agreement:.1%}")
@@ -0,0 +1,136 @@
+"""
+Startup benchmark for the automated development workflow.
+
+Each scenario runs in a fresh interpreter and records wall-clock time and peak RSS:
+  - help:     `python main.py --help`
+  - workflow: `import main` followed by constructing `AutomatedDevWorkflow`
+
+Usage:
+    python benchmarks/startup.py --repeat 5 --output startup.json
+    python benchmarks/startup.py --baseline startup.json --tolerance 0.25
+
+With --baseline, the script exits non-zero if any scenario's median time or
+peak RSS regresses by more than the tolerance.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should never be imported just to start the workflow
+HEAVY_MODULES = ["torch", "tensorflow", "transformers", "spacy", "plotly", "seaborn",
+                 "matplotlib", "pandas", "sklearn", "datasets", "anthropic"]
+
+_PROBE_PRELUDE = """
+import sys, time, json, resource, contextlib, io
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+"""
+
+_PROBE_EPILOGUE = """
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss_mb = rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print("@@STARTUP@@" + json.dumps({{"seconds": elapsed, "peak_rss_mb": rss_mb, "heavy_modules": heavy}}))
+"""
+
+SCENARIOS = {
+    "help": """
+import runpy
+sys.argv = ["main.py", "--help"]
+with contextlib.redirect_stdout(io.StringIO()):
+    try:
+        runpy.run_path({main!r}, run_name="__main__")
+    except SystemExit:
+        pass
+""",
+    "workflow": """
+import main
+main.AutomatedDevWorkflow(project_name="startup-benchmark", openai_api_key="sk-startup-benchmark")
+""",
+}
+
+
+def run_probe(scenario):
+    """
+    Run one scenario in a fresh interpreter and return its measurements.
+    """
+    code = (_PROBE_PRELUDE.format(root=REPO_ROOT)
+            + SCENARIOS[scenario].format(main=os.path.join(REPO_ROOT, "main.py"))
+            + _PROBE_EPILOGUE.format(heavy=HEAVY_MODULES))
+    # Run outside the repo so constructing the workflow does not create ./project_repo here
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = subprocess.run([sys.executable, "-c", code], cwd=workdir,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith("@@STARTUP@@"):
+            return json.loads(line[len("@@STARTUP@@"):])
+    raise RuntimeError(f"Scenario '{scenario}' failed:\n{proc.stderr}")
+
+
+def run_benchmark(repeat=5):
+    """
+    Run every scenario `repeat` times and return the median measurements.
+    """
+    results = {}
+    for scenario in SCENARIOS:
+        runs = [run_probe(scenario) for _ in range(repeat)]
+        results[scenario] = {
+            "seconds": statistics.median(r["seconds"] for r in runs),
+            "peak_rss_mb": statistics.median(r["peak_rss_mb"] for r in runs),
+            "heavy_modules": sorted(set(m for r in runs for m in r["heavy_modules"])),
+            "repeat": repeat,
+        }
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare results with a baseline and return a list of human-readable regressions.
+    """
+    regressions = []
+    for scenario, current in results.items():
+        previous = baseline.get(scenario)
+        if previous is None:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            limit = previous[metric] * (1.0 + tolerance)
+            if current[metric] > limit:
+                regressions.append(f"{scenario}.{metric}: {current[metric]:.3f} > {limit:.3f} "
+                                   f"(baseline {previous[metric]:.3f})")
+        new_heavy = set(current["heavy_modules"]) - set(previous.get("heavy_modules", []))
+        if new_heavy:
+            regressions.append(f"{scenario}: newly imported heavy modules {sorted(new_heavy)}")
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Startup time and memory benchmark")
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario (median is reported).')
+    parser.add_argument('--output', type=str, default=None, help='Write results as JSON to this file.')
+    parser.add_argument('--baseline', type=str, default=None, help='Baseline JSON to check for regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression.')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    results = run_benchmark(repeat=args.repeat)
+    for scenario, r in results.items():
+        heavy = ", ".join(r["heavy_modules"]) or "none"
+        print(f"{scenario:<10} {r['seconds']:.3f}s  peak RSS {r['peak_rss_mb']:.1f} MB  heavy modules: {heavy}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
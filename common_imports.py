@@ -8,54 +8,158 @@ import logging
 import random
 import pathlib
 import argparse
+import importlib
 import subprocess
 import collections
+import threading
+import types
+
+# Lazy-loading import layer
+#
+# Heavy third-party libraries are bound to lightweight proxies that import the
+# real module (or attribute) on first use, so `from common_imports import *`
+# costs milliseconds instead of seconds. `_LAZY_LOCK` serializes the first
+# import so concurrent threads never observe a half-initialized module.
+_LAZY_LOCK = threading.RLock()
+
+
+class LazyModule(types.ModuleType):
+    """
+    Module proxy that imports `name` on first attribute access.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_lazy_target"] = None
+
+    def _load(self):
+        module = self.__dict__["_lazy_target"]
+        if module is None:
+            with _LAZY_LOCK:
+                module = self.__dict__["_lazy_target"]
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_lazy_target"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_lazy_target"] is not None else "not loaded"
+        return f"<lazy module '{self.__name__}' ({state})>"
+
+
+class LazyAttribute:
+    """
+    Proxy for `from module import attr` that resolves on first call or attribute access.
+    """
+    def __init__(self, module_name, attr):
+        self._lazy_module = module_name
+        self._lazy_attr = attr
+        self._lazy_target = None
+
+    def _load(self):
+        target = self._lazy_target
+        if target is None:
+            with _LAZY_LOCK:
+                if self._lazy_target is None:
+                    module = importlib.import_module(self._lazy_module)
+                    self._lazy_target = getattr(module, self._lazy_attr)
+                target = self._lazy_target
+        return target
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr.startswith("_lazy_"):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._load())
+
+    def __repr__(self):
+        return f"<lazy attribute '{self._lazy_module}.{self._lazy_attr}'>"
+
+
+def lazy_import(name, attr=None):
+    """
+    Returns a proxy for module `name` (or for `name.attr` if `attr` is given)
+    that defers the actual import until the object is first used.
+    Modules that are already imported are returned directly.
+    """
+    if attr is None:
+        if name in sys.modules:
+            return sys.modules[name]
+        return LazyModule(name)
+    if name in sys.modules and hasattr(sys.modules[name], attr):
+        return getattr(sys.modules[name], attr)
+    return LazyAttribute(name, attr)
+
+
+def is_loaded(obj):
+    """
+    Returns True if `obj` is a real module/object or a lazy proxy that has already been resolved.
+    """
+    if isinstance(obj, LazyModule):
+        return obj.__dict__["_lazy_target"] is not None
+    if isinstance(obj, LazyAttribute):
+        return obj._lazy_target is not None
+    return True
+
 
 # Data manipulation and analysis
-import pandas as pd
-import numpy as np
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
 import csv
-import yaml
+yaml = lazy_import("yaml")
 import sqlite3
 import pickle
 
 # Visualization
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
+plt = lazy_import("matplotlib.pyplot")
+sns = lazy_import("seaborn")
+px = lazy_import("plotly.express")
 
 # Hugging Face & Transformers
-import transformers
-import huggingface_hub
+transformers = lazy_import("transformers")
+huggingface_hub = lazy_import("huggingface_hub")
 
 # Deep learning frameworks
-import torch
-import torch.nn as nn
-import torch.optim as optim
-import tensorflow as tf
+torch = lazy_import("torch")
+nn = lazy_import("torch.nn")
+optim = lazy_import("torch.optim")
+tf = lazy_import("tensorflow")
 
 # NLP Libraries
-import nltk
-import spacy
-import sacremoses
+nltk = lazy_import("nltk")
+spacy = lazy_import("spacy")
+sacremoses = lazy_import("sacremoses")
 
 # Performance acceleration libraries
-import accelerate
+accelerate = lazy_import("accelerate")
 
 # Scikit-learn for machine learning
-import sklearn
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score, f1_score, classification_report
-from sklearn.preprocessing import StandardScaler
-from sklearn.feature_extraction.text import TfidfVectorizer
+sklearn = lazy_import("sklearn")
+train_test_split = lazy_import("sklearn.model_selection", "train_test_split")
+accuracy_score = lazy_import("sklearn.metrics", "accuracy_score")
+f1_score = lazy_import("sklearn.metrics", "f1_score")
+classification_report = lazy_import("sklearn.metrics", "classification_report")
+StandardScaler = lazy_import("sklearn.preprocessing", "StandardScaler")
+TfidfVectorizer = lazy_import("sklearn.feature_extraction.text", "TfidfVectorizer")
 
 # Statistical analysis
-import scipy
-from scipy import stats
+scipy = lazy_import("scipy")
+stats = lazy_import("scipy.stats")
 
 # Image processing and handling
-from PIL import Image
-from skimage import io, color
+Image = lazy_import("PIL.Image")
+io = lazy_import("skimage.io")
+color = lazy_import("skimage.color")
 
 # Parallel processing
 import multiprocessing
@@ -65,4 +169,4 @@ import hashlib
 import uuid
 import base64
 import warnings
-from tqdm import tqdm
+tqdm = lazy_import("tqdm", "tqdm")
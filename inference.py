@@ -1,41 +1,274 @@
 import time
 import os
+import asyncio
+import contextlib
+import weakref
 import json
-import tiktoken
+import collections.abc
+import threading
+import hashlib
+import tempfile
+import contextvars
+import httpx
 from openai import OpenAI
 import openai
-import anthropic
+from common_imports import lazy_import
+from ratelimit import provider_guard, configure_rate_limits, rate_limit_stats, CircuitOpenError, RetriesExhaustedError
+from tracing import TRACER
+from llm_cache import ResponseCache, CacheMissError, DEFAULT_CACHE_PATH
+from utils import get_encoding
 
-# Token tracking dictionaries
-TOKENS_IN = {}
-TOKENS_OUT = {}
+# Only needed for Claude models, so defer the import until first use
+anthropic = lazy_import("anthropic")
 
-# Initialize encoding once for all cost estimations
-ENCODING = tiktoken.encoding_for_model("gpt-4o")
+# Token accounting
+#
+# Every thread records into its own shard, so the hot path never takes a lock or
+# races with other threads; readers sum the shards. When a thread exits its shard is
+# folded into a retired total, so pools that come and go do not leave shards behind
+# for every reader to sum. Calls are attributed to the
+# agent set with agent_scope() (a context variable, so it follows asyncio tasks).
+_CURRENT_AGENT = contextvars.ContextVar("autodev_agent", default=None)
+
+@contextlib.contextmanager
+def agent_scope(agent_name):
+    """Attribute LLM calls made inside the block to `agent_name`."""
+    token = _CURRENT_AGENT.set(agent_name)
+    try:
+        yield
+    finally:
+        _CURRENT_AGENT.reset(token)
+
+def _new_entry():
+    # cached_in: input tokens served from the provider's prompt cache; cache_write_in: tokens written to it
+    return {"in": 0, "out": 0, "cached_in": 0, "cache_write_in": 0, "calls": 0, "estimated_calls": 0}
+
+class _ShardOwner:
+    """Held only by a thread's thread-local storage; it is collected when the thread exits."""
+    __slots__ = ("shard", "__weakref__")
+
+    def __init__(self, shard):
+        self.shard = shard
+
+def _add_entries(total, entries):
+    for key, entry in entries.items():
+        merged = total.setdefault(key, _new_entry())
+        for field, value in dict(entry).items():
+            merged[field] += value
+
+class TokenAccounting:
+    """
+    Per-thread token counters keyed by (model, agent), aggregated on read.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        # Counters of threads that have exited
+        self._retired = {}
+        self._register_lock = threading.Lock()
+
+    def _shard(self):
+        owner = getattr(self._local, "owner", None)
+        if owner is None:
+            owner = _ShardOwner({})
+            with self._register_lock:
+                self._shards.append(owner.shard)
+            self._local.owner = owner
+            weakref.finalize(owner, self._retire, owner.shard)
+        return owner.shard
+
+    def _retire(self, shard):
+        # Runs once the owning thread has exited, so nothing writes to the shard any more
+        with self._register_lock:
+            self._shards = [other for other in self._shards if other is not shard]
+            _add_entries(self._retired, shard)
+
+    def record(self, model, tokens_in, tokens_out, agent=None, estimated=False, cached_in=0, cache_write_in=0):
+        """
+        Add one call's tokens. `estimated` marks counts that came from local tokenization.
+        `tokens_in` is the whole input; `cached_in` and `cache_write_in` are the parts of it
+        read from and written to the provider's prompt cache.
+        """
+        shard = self._shard()
+        key = (model, agent if agent is not None else _CURRENT_AGENT.get())
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = _new_entry()
+        entry["in"] += tokens_in
+        entry["out"] += tokens_out
+        entry["cached_in"] += cached_in
+        entry["cache_write_in"] += cache_write_in
+        entry["calls"] += 1
+        if estimated:
+            entry["estimated_calls"] += 1
+
+    def _merged(self):
+        merged = {}
+        with self._register_lock:
+            shards = list(self._shards)
+            _add_entries(merged, self._retired)
+        for shard in shards:
+            # dict() copies a plain dict atomically under the GIL, even while its owner thread writes
+            _add_entries(merged, dict(shard))
+        return merged
+
+    def totals(self, by="model"):
+        """
+        Return token totals grouped by "model", "agent" or "model_agent".
+        """
+        grouped = {}
+        for (model, agent), entry in self._merged().items():
+            group = {"model": model, "agent": agent or "unattributed", "model_agent": (model, agent or "unattributed")}[by]
+            total = grouped.setdefault(group, _new_entry())
+            for field, value in entry.items():
+                total[field] += value
+        return grouped
+
+    def thread_usage(self, model):
+        """
+        Return the current thread's counters for `model`, summed over agents. Two reads around a
+        synchronous call give exactly that call's usage, whatever other threads are doing.
+        """
+        total = _new_entry()
+        for (entry_model, _), entry in dict(self._shard()).items():
+            if entry_model == model:
+                for field, value in dict(entry).items():
+                    total[field] += value
+        return total
+
+    def snapshot(self):
+        """Return a JSON-serializable copy of all counters."""
+        return [{"model": model, "agent": agent, **entry} for (model, agent), entry in self._merged().items()]
+
+    def restore(self, snapshot):
+        """Add counters previously returned by snapshot() to the current thread's shard."""
+        shard = self._shard()
+        for item in snapshot:
+            entry = shard.setdefault((item["model"], item["agent"]), _new_entry())
+            for field in entry:
+                entry[field] += item.get(field, 0)
+
+    def reset(self):
+        with self._register_lock:
+            for shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+class _TokenTotals(collections.abc.Mapping):
+    """Read-only per-model view of one direction ("in" or "out") of the accounting."""
+    def __init__(self, accounting, field):
+        self._accounting = accounting
+        self._field = field
+
+    def _values(self):
+        return {model: entry[self._field] for model, entry in self._accounting.totals().items()}
+
+    def __getitem__(self, model):
+        return self._values()[model]
+
+    def __iter__(self):
+        return iter(self._values())
+
+    def __len__(self):
+        return len(self._values())
+
+TOKEN_ACCOUNTING = TokenAccounting()
+
+# Token tracking dictionaries (read-only views kept for existing callers)
+TOKENS_IN = _TokenTotals(TOKEN_ACCOUNTING, "in")
+TOKENS_OUT = _TokenTotals(TOKEN_ACCOUNTING, "out")
+
+def token_usage(by="model"):
+    """Return token totals grouped by "model", "agent" or "model_agent"."""
+    return TOKEN_ACCOUNTING.totals(by=by)
+
+# USD per token, by model
+COST_PER_TOKEN_IN = {
+    "gpt-4o": 2.50 / 1000000,
+    "gpt-4o-mini": 0.150 / 1000000,
+    "o1-preview": 15.00 / 1000000,
+    "o1-mini": 3.00 / 1000000,
+    "claude-3-5-sonnet": 3.00 / 1000000,
+    "claude-3.5-sonnet": 3.00 / 1000000,
+    "deepseek-chat": 1.00 / 1000000,
+    "o1": 15.00 / 1000000,
+}
+COST_PER_TOKEN_OUT = {
+    "gpt-4o": 10.00 / 1000000,
+    "gpt-4o-mini": 0.6 / 1000000,
+    "o1-preview": 60.00 / 1000000,
+    "o1-mini": 12.00 / 1000000,
+    "claude-3-5-sonnet": 12.00 / 1000000,
+    "claude-3.5-sonnet": 12.00 / 1000000,
+    "deepseek-chat": 5.00 / 1000000,
+    "o1": 60.00 / 1000000,
+}
+
+# Price of prompt-cache reads and writes relative to regular input tokens
+CACHE_READ_FACTOR = {"openai": 0.5, "anthropic": 0.1}
+CACHE_WRITE_FACTOR = {"openai": 1.0, "anthropic": 1.25}
+
+def estimate_cost(model, tokens_in, tokens_out, cached_in=0, cache_write_in=0):
+    """
+    Return the cost in USD of `tokens_in` input and `tokens_out` output tokens of `model`,
+    where `cached_in` input tokens were read from and `cache_write_in` written to the prompt cache.
+    """
+    provider = "anthropic" if model.startswith("claude") else "openai"
+    uncached = tokens_in - cached_in - cache_write_in
+    input_tokens = uncached + cached_in * CACHE_READ_FACTOR[provider] + cache_write_in * CACHE_WRITE_FACTOR[provider]
+    return COST_PER_TOKEN_IN.get(model, 0.0) * input_tokens + COST_PER_TOKEN_OUT.get(model, 0.0) * tokens_out
 
 def curr_cost_est():
     """Estimate the current cost based on tokens used."""
-    costmap_in = {
-        "gpt-4o": 2.50 / 1000000,
-        "gpt-4o-mini": 0.150 / 1000000,
-        "o1-preview": 15.00 / 1000000,
-        "o1-mini": 3.00 / 1000000,
-        "claude-3-5-sonnet": 3.00 / 1000000,
-        "deepseek-chat": 1.00 / 1000000,
-        "o1": 15.00 / 1000000,
-    }
-    costmap_out = {
-        "gpt-4o": 10.00 / 1000000,
-        "gpt-4o-mini": 0.6 / 1000000,
-        "o1-preview": 60.00 / 1000000,
-        "o1-mini": 12.00 / 1000000,
-        "claude-3-5-sonnet": 12.00 / 1000000,
-        "deepseek-chat": 5.00 / 1000000,
-        "o1": 60.00 / 1000000,
+    totals = TOKEN_ACCOUNTING.totals()
+    return sum(estimate_cost(m, entry["in"], entry["out"], entry["cached_in"], entry["cache_write_in"])
+               for m, entry in totals.items())
+
+def prompt_cache_stats():
+    """Return, per model, the share of input tokens served from the provider's prompt cache."""
+    return {
+        model: {"in": entry["in"], "cached_in": entry["cached_in"], "cache_write_in": entry["cache_write_in"],
+                "cached_ratio": entry["cached_in"] / entry["in"] if entry["in"] else 0.0}
+        for model, entry in TOKEN_ACCOUNTING.totals().items()
     }
-    total_cost = sum(costmap_in[m] * TOKENS_IN.get(m, 0) for m in costmap_in) + \
-                 sum(costmap_out[m] * TOKENS_OUT.get(m, 0) for m in costmap_out)
-    return total_cost
+
+# Shared on-disk response cache, configured from the environment until configure_cache() is called
+_RESPONSE_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def configure_cache(path=None, mode=None, **kwargs):
+    """
+    Replace the process-wide response cache.
+    `mode` is one of "off", "readwrite", "readonly" or "replay"; extra kwargs go to ResponseCache.
+    """
+    with _CACHE_LOCK:
+        return _configure_cache_locked(path, mode, **kwargs)
+
+def _configure_cache_locked(path=None, mode=None, **kwargs):
+    global _RESPONSE_CACHE
+    if _RESPONSE_CACHE is not None:
+        _RESPONSE_CACHE.close()
+    _RESPONSE_CACHE = ResponseCache(
+        path=path or os.getenv("AUTODEV_LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+        mode=mode or os.getenv("AUTODEV_LLM_CACHE", "readwrite"),
+        **kwargs
+    )
+    return _RESPONSE_CACHE
+
+def get_response_cache():
+    """Return the process-wide response cache, creating it on first use."""
+    cache = _RESPONSE_CACHE
+    if cache is None:
+        # Check and create under one lock so concurrent first callers share a single cache
+        with _CACHE_LOCK:
+            cache = _RESPONSE_CACHE
+            if cache is None:
+                cache = _configure_cache_locked()
+    return cache
+
+def cache_stats():
+    """Return hit/miss counters of the response cache."""
+    return get_response_cache().stats()
 
 def get_api_key(api_key_arg, env_var):
     """
@@ -47,71 +280,640 @@ def get_api_key(api_key_arg, env_var):
         raise Exception(f"No API key provided. Please set the {env_var} environment variable or pass it as an argument.")
     return key
 
-def query_openai(model_str, messages, temperature):
+# Provider client registry
+#
+# One client per (provider, api key) is created on first use and shared by every
+# thread afterwards, so HTTP keep-alive connections and TLS sessions are reused
+# instead of being rebuilt on each request.
+CLIENT_POOL_LIMITS = {
+    "max_connections": int(os.getenv("AUTODEV_MAX_CONNECTIONS", "100")),
+    "max_keepalive_connections": int(os.getenv("AUTODEV_MAX_KEEPALIVE", "20")),
+    "keepalive_expiry": float(os.getenv("AUTODEV_KEEPALIVE_EXPIRY", "30.0")),
+}
+_CLIENTS = {}
+# Async clients are bound to the event loop that created them, so they are kept per loop
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+_CLIENT_STATS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+class ConnectionStats:
+    """
+    Counts requests and newly opened TCP connections for one pooled client.
+    Every request that did not open a connection reused a pooled one.
+    """
+    def __init__(self, provider, is_async=False):
+        self.provider = provider
+        self.is_async = is_async
+        self.requests = 0
+        self.new_connections = 0
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def trace(self, event_name, info):
+        # httpcore reports each connection it opens through the "trace" request extension
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    async def atrace(self, event_name, info):
+        self.trace(event_name, info)
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                "provider": self.provider,
+                "async": self.is_async,
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+class _CountingTransport(httpx.HTTPTransport):
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    def handle_request(self, request):
+        self._stats.record_request()
+        request.extensions["trace"] = self._stats.trace
+        return super().handle_request(request)
+
+class _AsyncCountingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self._stats = stats
+
+    async def handle_async_request(self, request):
+        self._stats.record_request()
+        request.extensions["trace"] = self._stats.atrace
+        return await super().handle_async_request(request)
+
+def _pool_limits():
+    return httpx.Limits(**CLIENT_POOL_LIMITS)
+
+def _key_fingerprint(api_key):
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+
+def configure_client_pool(max_connections=None, max_keepalive_connections=None, keepalive_expiry=None):
+    """
+    Change the connection pool size used by provider clients.
+    Existing clients are closed so the new limits apply to the next request.
+    """
+    updates = {
+        "max_connections": max_connections,
+        "max_keepalive_connections": max_keepalive_connections,
+        "keepalive_expiry": keepalive_expiry,
+    }
+    with _CLIENTS_LOCK:
+        CLIENT_POOL_LIMITS.update({k: v for k, v in updates.items() if v is not None})
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
+        # Async clients can only be closed from their own loop; dropping them releases the pools
+        _ASYNC_CLIENTS.clear()
+
+def _connection_stats(provider, key_fingerprint, is_async):
+    stats_key = (provider, key_fingerprint, is_async)
+    stats = _CLIENT_STATS.get(stats_key)
+    if stats is None:
+        stats = _CLIENT_STATS[stats_key] = ConnectionStats(provider, is_async=is_async)
+    return stats
+
+def get_client(provider, api_key=None):
+    """
+    Return the shared client for `provider` ("openai" or "anthropic") and `api_key`,
+    creating it with a keep-alive connection pool on first use. Clients are thread-safe.
+    """
+    registry_key = (provider, _key_fingerprint(api_key))
+    client = _CLIENTS.get(registry_key)
+    if client is not None:
+        return client
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(registry_key)
+        if client is None:
+            stats = _connection_stats(provider, registry_key[1], False)
+            transport = _CountingTransport(stats, limits=_pool_limits())
+            if provider == "openai":
+                client = OpenAI(api_key=api_key, max_retries=0, http_client=openai.DefaultHttpxClient(transport=transport))
+            elif provider == "anthropic":
+                client = anthropic.Anthropic(api_key=api_key, max_retries=0, http_client=anthropic.DefaultHttpxClient(transport=transport))
+            else:
+                raise ValueError(f"Unsupported provider: {provider}")
+            _CLIENTS[registry_key] = client
+    return client
+
+def get_async_client(provider, api_key=None):
+    """
+    Async counterpart of get_client(): one pooled AsyncOpenAI/AsyncAnthropic client
+    per provider and key for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    registry_key = (provider, _key_fingerprint(api_key))
+    with _CLIENTS_LOCK:
+        loop_clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        client = loop_clients.get(registry_key)
+        if client is None:
+            stats = _connection_stats(provider, registry_key[1], True)
+            transport = _AsyncCountingTransport(stats, limits=_pool_limits())
+            if provider == "openai":
+                client = openai.AsyncOpenAI(api_key=api_key, max_retries=0, http_client=openai.DefaultAsyncHttpxClient(transport=transport))
+            elif provider == "anthropic":
+                client = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0, http_client=anthropic.DefaultAsyncHttpxClient(transport=transport))
+            else:
+                raise ValueError(f"Unsupported provider: {provider}")
+            loop_clients[registry_key] = client
+    return client
+
+def client_stats():
+    """
+    Return connection reuse statistics for every pooled client.
+    """
+    with _CLIENTS_LOCK:
+        entries = list(_CLIENT_STATS.items())
+    stats = []
+    for (provider, key_fingerprint, _), conn_stats in entries:
+        snapshot = conn_stats.snapshot()
+        snapshot["key"] = key_fingerprint
+        stats.append(snapshot)
+    return stats
+
+# Process-wide cap on concurrent async requests. asyncio primitives belong to one
+# event loop, so each loop gets its own semaphore sized from MAX_IN_FLIGHT.
+MAX_IN_FLIGHT = int(os.getenv("AUTODEV_MAX_IN_FLIGHT", "32"))
+# Streamed answers bound for the response cache are kept in memory up to this size, then spilled to disk
+STREAM_SPOOL_BYTES = 1024 * 1024
+_IN_FLIGHT_SEMAPHORES = weakref.WeakKeyDictionary()
+_IN_FLIGHT = {"current": 0, "peak": 0}
+
+def set_max_in_flight(limit):
+    """
+    Set the maximum number of concurrent aquery_model() requests.
+    Takes effect for event loops that have not issued a request yet.
+    """
+    global MAX_IN_FLIGHT
+    if limit < 1:
+        raise ValueError("max in-flight requests must be at least 1")
+    MAX_IN_FLIGHT = limit
+    _IN_FLIGHT_SEMAPHORES.clear()
+
+def in_flight_stats():
+    """Return the current and peak number of in-flight async requests."""
+    return dict(_IN_FLIGHT, limit=MAX_IN_FLIGHT)
+
+@contextlib.asynccontextmanager
+async def _in_flight_slot():
+    loop = asyncio.get_running_loop()
+    semaphore = _IN_FLIGHT_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = _IN_FLIGHT_SEMAPHORES[loop] = asyncio.Semaphore(MAX_IN_FLIGHT)
+    async with semaphore:
+        _IN_FLIGHT["current"] += 1
+        _IN_FLIGHT["peak"] = max(_IN_FLIGHT["peak"], _IN_FLIGHT["current"])
+        try:
+            yield
+        finally:
+            _IN_FLIGHT["current"] -= 1
+
+# Both providers only cache prompt prefixes of at least this many tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+def _build_messages(system_prompt, prompt, context=None):
+    """
+    Chat messages of one request. The shared `context` (project description, reference documents)
+    follows the agent instructions as a second system message, so instructions plus context form a
+    prefix that is identical across subtasks and only the user turn after it varies.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if context:
+        messages.append({"role": "system", "content": context})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def _cached_prefix(messages):
+    """Return the stable prompt prefix (the system messages) if it is long enough to be cached, else None."""
+    prefix = "\n\n".join(message["content"] for message in messages if message["role"] == "system")
+    return prefix if len(prefix) // 4 >= PROMPT_CACHE_MIN_TOKENS else None
+
+def _system_blocks(system_prompt, context=None):
+    """
+    Anthropic system prompt: the agent instructions, then the shared context. When the two are long
+    enough to be cached, a cache breakpoint after the last block makes them a prompt-cache prefix and
+    only the user turn after it is processed in full.
+    """
+    blocks = [{"type": "text", "text": system_prompt}]
+    if context:
+        blocks.append({"type": "text", "text": context})
+    if _cached_prefix(_build_messages(system_prompt, "", context)) is not None:
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return blocks
+
+def _prompt_cache_body(messages):
+    """
+    OpenAI caches the longest previously seen prefix automatically. For prefixes long enough to be
+    cached, a key derived from them routes requests sharing the prefix to the same cache.
+    """
+    prefix = _cached_prefix(messages)
+    if prefix is None:
+        return {}
+    return {"prompt_cache_key": hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]}
+
+def query_openai(model_str, messages, temperature, api_key=None):
     """
     Queries the OpenAI API using the provided model and messages.
     """
-    client = OpenAI()
+    client = get_client("openai", api_key)
     return client.chat.completions.create(
         model=f"{model_str}",
         messages=messages,
-        temperature=temperature
+        temperature=temperature,
+        extra_body=_prompt_cache_body(messages)
     )
 
-def query_anthropic(system_prompt, prompt):
+def _openai_usage(completion):
+    """Return (input, output, cached input, cache-write input) tokens of an OpenAI response."""
+    usage = getattr(completion, "usage", None)
+    if usage is None or usage.prompt_tokens is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) or 0
+    return usage.prompt_tokens, usage.completion_tokens or 0, cached, 0
+
+def _anthropic_usage(completion):
+    """
+    Same as _openai_usage() for an Anthropic message dict. Anthropic reports cache reads and
+    writes separately from input_tokens, so they are added back to get the whole input.
+    """
+    usage = completion.get("usage") or {}
+    if usage.get("input_tokens") is None:
+        return None
+    cached = usage.get("cache_read_input_tokens") or 0
+    written = usage.get("cache_creation_input_tokens") or 0
+    return usage["input_tokens"] + cached + written, usage.get("output_tokens") or 0, cached, written
+
+def query_anthropic(system_prompt, prompt, api_key=None, context=None):
     """
     Queries the Anthropic API using the provided system prompt and user prompt.
+    Returns the answer text and the token usage reported by the API (see _anthropic_usage()).
     """
-    anthropic_key = get_api_key(None, "ANTHROPIC_API_KEY")
-    client = anthropic.Anthropic(api_key=anthropic_key)
+    anthropic_key = get_api_key(api_key, "ANTHROPIC_API_KEY")
+    client = get_client("anthropic", anthropic_key)
     message = client.messages.create(
         model="claude-3-5-sonnet-latest",
-        system=system_prompt,
+        max_tokens=4096,
+        system=_system_blocks(system_prompt, context),
         messages=[{"role": "user", "content": prompt}]
     )
     completion = json.loads(message.to_json())
     # Assuming the answer is stored under content[0]["text"]
-    return completion["content"][0]["text"]
+    return completion["content"][0]["text"], _anthropic_usage(completion)
+
+def stream_openai(model_str, messages, temperature, api_key=None):
+    """
+    Streams an OpenAI chat completion, yielding text chunks as they arrive.
+    The generator's return value is the token usage (see _openai_usage()), if reported.
+    """
+    client = get_client("openai", api_key)
+    stream = client.chat.completions.create(
+        model=f"{model_str}",
+        messages=messages,
+        temperature=temperature,
+        stream=True,
+        stream_options={"include_usage": True},
+        extra_body=_prompt_cache_body(messages)
+    )
+    usage = None
+    for event in stream:
+        if event.usage is not None:
+            usage = _openai_usage(event)
+        if event.choices and event.choices[0].delta.content:
+            yield event.choices[0].delta.content
+    return usage
+
+def stream_anthropic(system_prompt, prompt, api_key=None, context=None):
+    """
+    Streams an Anthropic message, yielding text chunks as they arrive.
+    The generator's return value is the token usage, as returned by _anthropic_usage().
+    """
+    anthropic_key = get_api_key(api_key, "ANTHROPIC_API_KEY")
+    client = get_client("anthropic", anthropic_key)
+    with client.messages.stream(
+        model="claude-3-5-sonnet-latest",
+        max_tokens=4096,
+        system=_system_blocks(system_prompt, context),
+        messages=[{"role": "user", "content": prompt}]
+    ) as stream:
+        for text in stream.text_stream:
+            yield text
+        message = stream.get_final_message()
+    return _anthropic_usage(json.loads(message.to_json()))
+
+async def aquery_openai(model_str, messages, temperature, api_key=None):
+    """
+    Async version of query_openai().
+    """
+    client = get_async_client("openai", api_key)
+    return await client.chat.completions.create(
+        model=f"{model_str}",
+        messages=messages,
+        temperature=temperature,
+        extra_body=_prompt_cache_body(messages)
+    )
+
+async def aquery_anthropic(system_prompt, prompt, api_key=None, context=None):
+    """
+    Async version of query_anthropic().
+    """
+    anthropic_key = get_api_key(api_key, "ANTHROPIC_API_KEY")
+    client = get_async_client("anthropic", anthropic_key)
+    message = await client.messages.create(
+        model="claude-3-5-sonnet-latest",
+        max_tokens=4096,
+        system=_system_blocks(system_prompt, context),
+        messages=[{"role": "user", "content": prompt}]
+    )
+    completion = json.loads(message.to_json())
+    return completion["content"][0]["text"], _anthropic_usage(completion)
+
+OPENAI_MODELS = ["gpt-4o-mini", "gpt4", "gpt-4o"]
+
+def _provider_for(model_str):
+    if model_str in OPENAI_MODELS:
+        return "openai"
+    if model_str == "claude-3.5-sonnet":
+        return "anthropic"
+    raise ValueError(f"Unsupported model: {model_str}")
+
+def _estimate_tokens(system_prompt, prompt):
+    # Rough size used to book rate-limit capacity before the request is sent
+    return (len(system_prompt) + len(prompt)) // 4
+
+def _resolve_api_keys(openai_api_key, anthropic_api_key):
+    if openai_api_key or os.getenv("OPENAI_API_KEY"):
+        openai_api_key = openai.api_key = get_api_key(openai_api_key, "OPENAI_API_KEY")
+    if anthropic_api_key or os.getenv("ANTHROPIC_API_KEY"):
+        anthropic_api_key = os.environ["ANTHROPIC_API_KEY"] = get_api_key(anthropic_api_key, "ANTHROPIC_API_KEY")
+    return openai_api_key, anthropic_api_key
+
+def _cache_lookup(model_str, messages, temperature, use_cache, cache_salt=None, cache_if=None):
+    """
+    Returns (cache, cache_key, cached_answer). cache_key is None when caching is disabled.
+    A recorded answer that `cache_if` rejects is ignored, so the request goes to the provider again.
+    """
+    cache = get_response_cache() if use_cache else None
+    if cache is None or not cache.enabled:
+        return None, None, None
+    cache_key = cache.make_key(model_str, messages, temperature, salt=cache_salt)
+    cached = cache.get(cache_key)
+    if cached is not None and cache_if is not None and not cache_if(cached):
+        cached = None
+    if cached is None and cache.mode == "replay":
+        raise CacheMissError(f"No recorded response for {model_str} request {cache_key[:12]} in replay mode")
+    return cache, cache_key, cached
+
+def _record_answer(model_str, system_prompt, prompt, answer, usage, cache, cache_key, print_cost, span=None, cache_if=None):
+    # Prefer the provider's own token counts; tokenize locally only when they are missing
+    if usage is not None:
+        TOKEN_ACCOUNTING.record(model_str, usage[0], usage[1], cached_in=usage[2], cache_write_in=usage[3])
+        tokens_in, tokens_out, cached_in = usage[0], usage[1], usage[2]
+    else:
+        encoding = get_encoding(model_str)
+        tokens_in, tokens_out, cached_in = len(encoding.encode(system_prompt + prompt)), len(encoding.encode(answer)), 0
+        TOKEN_ACCOUNTING.record(model_str, tokens_in, tokens_out, estimated=True)
+    if span is not None:
+        span.set(tokens_in=tokens_in, tokens_out=tokens_out, cached_tokens_in=cached_in)
+    if cache_key is not None and (cache_if is None or cache_if(answer)):
+        cache.put(cache_key, model_str, answer)
+    if print_cost:
+        print(f"Current cost estimate: ${curr_cost_est():.6f}")
 
 def query_model(model_str, prompt, system_prompt,
                 openai_api_key=None, anthropic_api_key=None,
-                tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5"):
+                tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5", use_cache=True,
+                stream=False, cache_salt=None, context=None, cache_if=None):
     """
     Queries the chosen model with retries, error handling, and cost estimation.
     Supports both OpenAI and Anthropic APIs.
+    Identical requests are answered from the response cache unless `use_cache` is False;
+    pass a distinct `cache_salt` to draw (and record) several independent samples of one request.
+    `cache_if(answer)` returning False keeps an answer the caller will reject (e.g. one without the
+    expected code block) out of the cache, so a rerun asks the provider again instead of replaying it.
+    With `stream=True` an iterator of text chunks is returned instead (see stream_model).
+    `context` is text shared by many requests (e.g. the project description); it is sent ahead of
+    `prompt` as part of the provider-cached prompt prefix.
+    Every call is traced as an "llm" span with one "attempt" span per provider request.
     """
+    if stream:
+        return stream_model(model_str, prompt, system_prompt, openai_api_key=openai_api_key,
+                            anthropic_api_key=anthropic_api_key, tries=tries, timeout=timeout, temp=temp,
+                            print_cost=print_cost, version=version, use_cache=use_cache,
+                            cache_salt=cache_salt, context=context, cache_if=cache_if)
+
     # Set API keys
-    if openai_api_key or os.getenv("OPENAI_API_KEY"):
-        openai.api_key = get_api_key(openai_api_key, "OPENAI_API_KEY")
-    if anthropic_api_key or os.getenv("ANTHROPIC_API_KEY"):
-        os.environ["ANTHROPIC_API_KEY"] = get_api_key(anthropic_api_key, "ANTHROPIC_API_KEY")
-    
+    openai_api_key, anthropic_api_key = _resolve_api_keys(openai_api_key, anthropic_api_key)
+
     # Prepare messages for the model
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": prompt}
-    ]
-    
-    # Try querying the model up to 'tries' times with exponential backoff
-    for attempt in range(tries):
-        try:
-            if model_str in ["gpt-4o-mini", "gpt4", "gpt-4o"]:
-                completion = query_openai(model_str, messages, temp or 0.7)
-                answer = completion.choices[0].message.content
-            elif model_str == "claude-3.5-sonnet":
-                answer = query_anthropic(system_prompt, prompt)
-            else:
-                raise ValueError(f"Unsupported model: {model_str}")
+    messages = _build_messages(system_prompt, prompt, context)
+    temperature = temp or 0.7
+
+    with TRACER.span(f"query_model {model_str}", "llm", model=model_str, cache_hits=0, retries=0) as span:
+        # Serve repeated requests from the response cache without touching the provider
+        cache, cache_key, cached = _cache_lookup(model_str, messages, temperature, use_cache, cache_salt, cache_if)
+        if cached is not None:
+            span.set(cache_hits=1)
+            return cached
+
+        # Retryable failures back off with jitter under the provider's shared limiter and circuit breaker
+        provider = _provider_for(model_str)
+        guard = provider_guard(provider)
+        estimate = _estimate_tokens(system_prompt, (context or "") + prompt)
+        for attempt in range(tries):
+            wait, probe = guard.before_attempt(estimate)
+            span.add("queue_wait_seconds", wait)
+            settled = False
+            try:
+                time.sleep(wait)
+                try:
+                    with TRACER.span(f"{model_str} attempt", "attempt", model=model_str, attempt=attempt + 1):
+                        if provider == "openai":
+                            completion = query_openai(model_str, messages, temperature, api_key=openai_api_key)
+                            answer = completion.choices[0].message.content
+                            usage = _openai_usage(completion)
+                        else:
+                            answer, usage = query_anthropic(system_prompt, prompt, api_key=anthropic_api_key, context=context)
+                except Exception as e:
+                    print(f"Model query error on attempt {attempt + 1}: {e}")
+                    settled = True
+                    delay = guard.on_failure(e, attempt, tries, base_delay=timeout)
+                    span.add("retries")
+                    time.sleep(delay)
+                    continue
+                settled = True
+                guard.on_success(usage[1] if usage is not None else 0)
+            finally:
+                # Interrupted attempts must not leave a half-open circuit waiting for them
+                if not settled:
+                    guard.abandon(probe)
+
+            _record_answer(model_str, system_prompt, (context or "") + prompt, answer, usage, cache, cache_key, print_cost, span, cache_if)
+            return answer
+
+def stream_model(model_str, prompt, system_prompt,
+                 openai_api_key=None, anthropic_api_key=None,
+                 tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5", use_cache=True,
+                 cache_salt=None, context=None, cache_if=None):
+    """
+    Generator version of query_model() that yields text chunks as the provider produces them.
+    Failures before the first chunk are retried; once output has been yielded an error is re-raised,
+    since the consumer has already seen a partial answer. When the answer is to be written to the
+    response cache it is spooled to a temporary file (in memory only up to STREAM_SPOOL_BYTES), so
+    memory stays bounded while streaming.
+    """
+    openai_api_key, anthropic_api_key = _resolve_api_keys(openai_api_key, anthropic_api_key)
+    messages = _build_messages(system_prompt, prompt, context)
+    temperature = temp or 0.7
+
+    # The consumer runs between chunks, so the span is never made current here
+    span = TRACER.start_span(f"query_model {model_str}", "llm", model=model_str, cache_hits=0, retries=0, stream=True)
+    error = None
+    try:
+        cache, cache_key, cached = _cache_lookup(model_str, messages, temperature, use_cache, cache_salt, cache_if)
+        if cached is not None:
+            span.set(cache_hits=1)
+            yield cached
+            return
+
+        provider = _provider_for(model_str)
+        guard = provider_guard(provider)
+        estimate = _estimate_tokens(system_prompt, (context or "") + prompt)
+        for attempt in range(tries):
+            wait, probe = guard.before_attempt(estimate)
+            span.add("queue_wait_seconds", wait)
+            spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_BYTES, mode="w+") if cache_key is not None else None
+            produced = False
+            chars_out = 0
+            settled = False
+            stream_error = None
+            try:
+                time.sleep(wait)
+                if provider == "openai":
+                    chunks = stream_openai(model_str, messages, temperature, api_key=openai_api_key)
+                else:
+                    chunks = stream_anthropic(system_prompt, prompt, api_key=anthropic_api_key, context=context)
+
+                while True:
+                    try:
+                        chunk = next(chunks)
+                    except StopIteration as stop:
+                        usage = stop.value
+                        break
+                    if not produced:
+                        span.set(time_to_first_chunk=time.time() - span.start)
+                    produced = True
+                    if spool is not None:
+                        spool.write(chunk)
+                    chars_out += len(chunk)
+                    yield chunk
+
+                settled = True
+                guard.on_success(usage[1] if usage is not None else chars_out // 4)
+                answer = None
+                if spool is not None:
+                    spool.seek(0)
+                    answer = spool.read()
+                if usage is not None:
+                    TOKEN_ACCOUNTING.record(model_str, usage[0], usage[1], cached_in=usage[2], cache_write_in=usage[3])
+                    span.set(tokens_in=usage[0], tokens_out=usage[1], cached_tokens_in=usage[2])
+                else:
+                    # Both providers report usage on streams; without it, estimate instead of re-reading the output
+                    encoding = get_encoding(model_str)
+                    tokens_out = len(encoding.encode(answer)) if answer is not None else chars_out // 4
+                    tokens_in = len(encoding.encode(system_prompt + (context or "") + prompt))
+                    TOKEN_ACCOUNTING.record(model_str, tokens_in, tokens_out, estimated=True)
+                    span.set(tokens_in=tokens_in, tokens_out=tokens_out, cached_tokens_in=0)
+                if answer is not None and (cache_if is None or cache_if(answer)):
+                    cache.put(cache_key, model_str, answer)
+                if print_cost:
+                    print(f"Current cost estimate: ${curr_cost_est():.6f}")
+                return
+
+            except Exception as e:
+                if produced:
+                    stream_error = e
+                    raise
+                print(f"Model query error on attempt {attempt + 1}: {e}")
+                settled = True
+                delay = guard.on_failure(e, attempt, tries, base_delay=timeout)
+                span.add("retries")
+                time.sleep(delay)
+            finally:
+                # Also reached on GeneratorExit when the consumer stops reading
+                if not settled:
+                    guard.abandon(probe, stream_error)
+                if spool is not None:
+                    spool.close()
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        span.finish(error=error)
+
+async def aquery_model(model_str, prompt, system_prompt,
+                       openai_api_key=None, anthropic_api_key=None,
+                       tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5", use_cache=True,
+                       cache_salt=None, context=None, cache_if=None):
+    """
+    Coroutine version of query_model() with the same caching, retry, token accounting and tracing.
+    At most MAX_IN_FLIGHT requests are sent concurrently; retries back off without blocking the loop.
+    """
+    openai_api_key, anthropic_api_key = _resolve_api_keys(openai_api_key, anthropic_api_key)
+    messages = _build_messages(system_prompt, prompt, context)
+    temperature = temp or 0.7
+
+    with TRACER.span(f"query_model {model_str}", "llm", model=model_str, cache_hits=0, retries=0) as span:
+        cache, cache_key, cached = _cache_lookup(model_str, messages, temperature, use_cache, cache_salt, cache_if)
+        if cached is not None:
+            span.set(cache_hits=1)
+            return cached
+
+        provider = _provider_for(model_str)
+        guard = provider_guard(provider)
+        estimate = _estimate_tokens(system_prompt, (context or "") + prompt)
+        for attempt in range(tries):
+            wait, probe = guard.before_attempt(estimate)
+            span.add("queue_wait_seconds", wait)
+            settled = False
+            try:
+                await asyncio.sleep(wait)
+                try:
+                    queued = time.time()
+                    async with _in_flight_slot():
+                        # Time spent waiting for an in-flight slot is queueing too
+                        span.add("queue_wait_seconds", time.time() - queued)
+                        with TRACER.span(f"{model_str} attempt", "attempt", model=model_str, attempt=attempt + 1):
+                            if provider == "openai":
+                                completion = await aquery_openai(model_str, messages, temperature, api_key=openai_api_key)
+                                answer = completion.choices[0].message.content
+                                usage = _openai_usage(completion)
+                            else:
+                                answer, usage = await aquery_anthropic(system_prompt, prompt, api_key=anthropic_api_key, context=context)
+                except Exception as e:
+                    print(f"Model query error on attempt {attempt + 1}: {e}")
+                    settled = True
+                    delay = guard.on_failure(e, attempt, tries, base_delay=timeout)
+                    span.add("retries")
+                    await asyncio.sleep(delay)
+                    continue
+                settled = True
+                guard.on_success(usage[1] if usage is not None else 0)
+            finally:
+                # Cancellation is a BaseException and skips the handler above
+                if not settled:
+                    guard.abandon(probe)
 
-            # Track tokens used for cost estimation
-            TOKENS_IN[model_str] = TOKENS_IN.get(model_str, 0) + len(ENCODING.encode(system_prompt + prompt))
-            TOKENS_OUT[model_str] = TOKENS_OUT.get(model_str, 0) + len(ENCODING.encode(answer))
-            if print_cost:
-                print(f"Current cost estimate: ${curr_cost_est():.6f}")
+            _record_answer(model_str, system_prompt, (context or "") + prompt, answer, usage, cache, cache_key, print_cost, span, cache_if)
             return answer
-        
-        except Exception as e:
-            print(f"Model query error on attempt {attempt + 1}: {e}")
-            time.sleep(timeout * (attempt + 1))  # Increase sleep time on each retry
-    
-    raise Exception("Max retries reached")
@@ -0,0 +1,196 @@
+import re
+import json
+import logging
+import threading
+import concurrent.futures
+
+from routing import route_query
+from utils import cached_token_count
+
+# Provider error messages that mean the request did not fit in the model's context window
+CONTEXT_OVERFLOW_PATTERN = re.compile(r"context[_ ]length|maximum context|context window|too many tokens|prompt is too long", re.I)
+
+_SCORE_LINE_PATTERN = re.compile(r"candidate\W*(\d+)\W+(?:score\W+)?(-?\d*\.?\d+)", re.I)
+
+
+def _is_context_overflow(error):
+    """True if `error`, or an error it was raised from (e.g. RetriesExhaustedError), reports a context overflow."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if CONTEXT_OVERFLOW_PATTERN.search(str(error)):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def _unit_score(score):
+    """Return `score` as a float if it lies in [0, 1], else None (e.g. an answer on a 1-10 scale)."""
+    score = float(score)
+    return score if 0.0 <= score <= 1.0 else None
+
+
+def parse_scores(response, count):
+    """
+    Extract one score per candidate from a judge response.
+    Accepts {"scores": [{"candidate": 0, "score": 0.8}, ...]}, a bare list of numbers or objects,
+    a {"0": 0.8} mapping, and falls back to "Candidate 0: 0.8" lines. Scores outside [0, 1] are
+    rejected like routing.score_validator does; rejected candidates and the ones the response does
+    not mention are None, so the judge asks again.
+    """
+    scores = [None] * count
+
+    def assign(index, score):
+        try:
+            index, score = int(index), _unit_score(score)
+        except (TypeError, ValueError):
+            return
+        if score is not None and 0 <= index < count:
+            scores[index] = score
+
+    match = re.search(r"[\[{].*[\]}]", response, re.DOTALL)
+    parsed = None
+    if match:
+        try:
+            parsed = json.loads(match.group(0))
+        except ValueError:
+            parsed = None
+    if isinstance(parsed, dict):
+        parsed = parsed.get("scores", parsed)
+    if isinstance(parsed, dict):
+        for index, score in parsed.items():
+            assign(index, score.get("score") if isinstance(score, dict) else score)
+    elif isinstance(parsed, list):
+        for position, item in enumerate(parsed):
+            if isinstance(item, dict):
+                assign(item.get("candidate", position), item.get("score"))
+            else:
+                assign(position, item)
+    if all(score is None for score in scores):
+        for index, score in _SCORE_LINE_PATTERN.findall(response):
+            assign(index, score)
+    if count == 1 and scores[0] is None:
+        number = re.search(r"-?\d*\.?\d+", response)
+        if number:
+            assign(0, number.group(0))
+    return scores
+
+
+class ListwiseJudge:
+    """
+    Scores several candidates in a single model request.
+
+    The shared `context` (project description, topic, ...) and the scoring instructions are sent
+    once per batch instead of once per candidate, as a system prefix the provider can cache. Candidates are packed into batches of at most
+    `max_batch` items and `max_prompt_tokens` tokens; a batch the provider rejects as too long is
+    split in half and retried, and candidates no response scores are judged again without the others.
+    With a `cascade` of models, a response that does not score every candidate is escalated to the
+    next model first. Batches are judged concurrently. Candidates that cannot be scored get 0.
+    """
+    def __init__(self, model, criteria, context="", openai_api_key=None, max_batch=8,
+                 max_prompt_tokens=60000, max_workers=4, cascade=None):
+        self.model = model
+        self.cascade = cascade
+        self.criteria = criteria
+        self.context = context
+        self.openai_api_key = openai_api_key
+        self.max_batch = max_batch
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_workers = max_workers
+        self.calls = 0
+        self.judged = 0
+        self._lock = threading.Lock()
+
+    def _system_prompt(self):
+        return f"""
+        You are an AI-powered reviewer comparing several candidates for the same task.
+        {self.criteria}
+        Score every candidate independently from 0 to 1, using the same scale for all of them.
+        Output only JSON of the form:
+        {{"scores": [{{"candidate": 0, "score": 0.8}}, {{"candidate": 1, "score": 0.4}}]}}
+        """
+
+    def _batches(self, candidates):
+        """Group candidate indices into batches that respect max_batch and max_prompt_tokens."""
+        overhead = cached_token_count(self._system_prompt() + self.context, self.model)
+        batches, batch, used = [], [], overhead
+        for index, candidate in enumerate(candidates):
+            tokens = cached_token_count(candidate, self.model)
+            if batch and (len(batch) >= self.max_batch or used + tokens > self.max_prompt_tokens):
+                batches.append(batch)
+                batch, used = [], overhead
+            batch.append(index)
+            used += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _judge_batch(self, candidates, indices):
+        """Return {index: score} for one batch, splitting it if the request is too long."""
+        listing = "\n\n".join(f"### Candidate {position}\n{candidates[index]}" for position, index in enumerate(indices))
+        prompt = f"Candidates:\n{listing}"
+        partial = [None] * len(indices)
+
+        def complete_scores(response):
+            # Incomplete answers are rejected, so a cascade escalates them to the next model;
+            # the scores they did give are kept in case no model scores the whole batch
+            scores = parse_scores(response, len(indices))
+            for position, score in enumerate(scores):
+                if score is not None:
+                    partial[position] = score
+            return scores if None not in scores else None
+
+        with self._lock:
+            self.calls += 1
+        try:
+            scores, _ = route_query(
+                self.cascade or [self.model],
+                system_prompt=self._system_prompt(),
+                prompt=prompt,
+                validator=complete_scores,
+                route="judge",
+                context=f"Context:\n{self.context}" if self.context else None,
+                openai_api_key=self.openai_api_key
+            )
+        except Exception as e:
+            if not _is_context_overflow(e):
+                raise
+            if len(indices) == 1:
+                logging.warning(f"Candidate {indices[0]} does not fit in the judge's context window")
+                return {indices[0]: None}
+            half = len(indices) // 2
+            return {**self._judge_batch(candidates, indices[:half]), **self._judge_batch(candidates, indices[half:])}
+        if scores is not None:
+            return dict(zip(indices, scores))
+        if len(indices) == 1:
+            return {indices[0]: partial[0]}
+        results = {index: score for index, score in zip(indices, partial) if score is not None}
+        missing = [index for index, score in zip(indices, partial) if score is None]
+        if len(missing) < len(indices):
+            # Judge only the candidates the responses left out
+            results.update(self._judge_batch(candidates, missing))
+        else:
+            half = len(indices) // 2
+            results.update({**self._judge_batch(candidates, indices[:half]), **self._judge_batch(candidates, indices[half:])})
+        return results
+
+    def score(self, candidates):
+        """
+        Return a list with one score in [0, 1] per candidate.
+        """
+        candidates = list(candidates)
+        if not candidates:
+            return []
+        batches = self._batches(candidates)
+        scores = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(batches)))) as executor:
+            for result in executor.map(lambda indices: self._judge_batch(candidates, indices), batches):
+                scores.update(result)
+        with self._lock:
+            self.judged += len(candidates)
+        return [scores.get(index) or 0.0 for index in range(len(candidates))]
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "candidates": self.judged,
+                    "candidates_per_call": self.judged / self.calls if self.calls else 0.0}
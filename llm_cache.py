@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "autodev", "llm_responses.sqlite")
+CACHE_MODES = ("off", "readwrite", "readonly", "replay")
+
+# Bump when the key derivation changes so stale entries are never served
+KEY_VERSION = "1"
+
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed store of LLM responses backed by SQLite.
+
+    Modes:
+      - "readwrite": serve hits, store new responses (default).
+      - "readonly":  serve hits, never write (misses still go to the provider).
+      - "replay":    serve hits, raise CacheMissError on a miss. Used for deterministic reruns.
+      - "off":       bypass the cache entirely.
+
+    Entries older than `max_age` seconds are not served (except in "replay" mode, which
+    must reproduce a recorded run) and are dropped, and the least recently used entries are
+    evicted once the stored responses exceed `max_bytes`. Eviction only runs in "readwrite"
+    mode so replays never lose recorded data.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, mode="readwrite", max_bytes=512 * 1024 * 1024,
+                 max_age=30 * 24 * 3600, evict_every=100):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}. Expected one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._puts_since_evict = 0
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # WAL lets several workflow processes read and write the same cache file
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER,"
+                " created REAL, accessed REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            conn.commit()
+            self._conn = conn
+            if self.mode == "readwrite":
+                self._evict_locked()
+        return self._conn
+
+    @staticmethod
+    def make_key(model, messages, temperature, salt=None):
+        """
+        Returns the SHA-256 digest of a canonical encoding of (model, messages, temperature).
+        A `salt` distinguishes intentionally repeated samples of the same request.
+        """
+        fields = {"v": KEY_VERSION, "model": model, "messages": messages, "temperature": temperature}
+        if salt is not None:
+            fields["salt"] = salt
+        payload = json.dumps(fields, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached response for `key`, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            expired = row is not None and self.max_age is not None and now - row[1] > self.max_age
+            if row is None or (expired and self.mode != "replay"):
+                self.misses += 1
+                return None
+            if self.mode == "readwrite":
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        """
+        Stores `response` under `key`. No-op unless the cache is in "readwrite" mode.
+        """
+        if self.mode != "readwrite" or response is None:
+            return
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, len(response.encode("utf-8")), now, now),
+            )
+            conn.commit()
+            self.stores += 1
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= self.evict_every:
+                self._evict_locked()
+
+    def evict(self):
+        """
+        Applies age- and size-based eviction now and returns the number of removed entries.
+        """
+        with self._lock:
+            self._connect()
+            return self._evict_locked()
+
+    def _evict_locked(self):
+        conn = self._conn
+        removed = 0
+        self._puts_since_evict = 0
+        if self.max_age is not None:
+            removed += conn.execute("DELETE FROM responses WHERE created < ?",
+                                    (time.time() - self.max_age,)).rowcount
+        if self.max_bytes is not None:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk entries from least to most recently used until we are under budget
+                excess, victims = total - self.max_bytes, []
+                for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC"):
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                removed += len(victims)
+        conn.commit()
+        self.evictions += removed
+        return removed
+
+    def clear(self):
+        """Removes every stored response."""
+        with self._lock:
+            self._connect().execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def stats(self):
+        """
+        Returns hit/miss counters and the current size of the store.
+        """
+        with self._lock:
+            entries, size = 0, 0
+            if self.enabled:
+                entries, size = self._connect().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -1,26 +1,41 @@
 from agents import *
 from copy import copy
 from common_imports import *
-from torch.backends.mkl import verbose
+from scheduler import TaskGraph, run_graph
+from tracing import TRACER
 
 import argparse
+import hashlib
+import json
 import pickle
 import os
 import time
+import threading
 
 DEFAULT_LLM_BACKBONE = "gpt-4o"
+CHECKPOINT_VERSION = 1
+CHECKPOINT_PATH = "./project_repo/.checkpoint.json"
+TRACE_PATH = "./project_repo/trace.jsonl"
+METRICS_PATH = "./project_repo/metrics.prom"
+# Token budget for reference document excerpts included with each subtask prompt
+REFERENCE_CONTEXT_TOKENS = 4000
 
 class AutomatedDevWorkflow:
-    def __init__(self, project_name, openai_api_key, max_steps=55, agent_model_backbone=f"{DEFAULT_LLM_BACKBONE}", notes=list(), human_in_loop_flag=None):
+    def __init__(self, project_name, openai_api_key, max_steps=55, agent_model_backbone=f"{DEFAULT_LLM_BACKBONE}", notes=list(), human_in_loop_flag=None, max_workers=4, stream_results=False):
         """
         Initialize the automated development workflow.
         @param project_name: (str) Description of the software project to develop.
         @param max_steps: (int) Maximum number of steps per phase.
         @param agent_model_backbone: (str or dict) Model backbone for agents.
         @param notes: (list) Development notes and guidelines.
+        @param max_workers: (int) Maximum number of subtasks executed concurrently.
+        @param stream_results: (bool) Stream model output into ./project_repo as it is generated.
         """
         self.notes = notes
         self.max_steps = max_steps
+        self.max_workers = max_workers
+        self.stream_results = stream_results
+        self.completed_subtasks = dict()
         self.openai_api_key = openai_api_key
         self.project_name = project_name
         self.model_backbone = agent_model_backbone
@@ -39,9 +54,26 @@ class AutomatedDevWorkflow:
             ("deployment", ["deploy application", "monitor performance"]),
             ("maintenance", ["bug fixes", "feature enhancements"])
         ]
+        # Subtasks only wait for the work they actually build on, so independent ones run concurrently
+        self.subtask_dependencies = {
+            "gather requirements": [],
+            "define scope": [],
+            "design components": ["gather requirements", "define scope"],
+            "define data structures": ["gather requirements", "define scope"],
+            "develop modules": ["design components", "define data structures"],
+            "write tests": ["design components", "define data structures"],
+            "integrate components": ["develop modules"],
+            "run tests": ["integrate components", "write tests"],
+            "deploy application": ["run tests"],
+            "monitor performance": ["deploy application"],
+            "bug fixes": ["run tests"],
+            "feature enhancements": ["deploy application"],
+        }
         self.phase_status = {subtask: False for _, subtasks in self.phases for subtask in subtasks}
         
-        self.statistics_per_phase = {subtask: {"time": 0.0, "steps": 0.0} for _, subtasks in self.phases for subtask in subtasks}
+        self.statistics_per_phase = {phase: {"time": 0.0, "steps": 0} for phase, _ in self.phases}
+        # "steps" counts the model calls made for a subtask
+        self.statistics_per_subtask = {subtask: {"time": 0.0, "steps": 0} for _, subtasks in self.phases for subtask in subtasks}
         
         self.engineer = SoftwareEngineerAgent(model=self.model_backbone, notes=self.notes, max_steps=self.max_steps, openai_api_key=self.openai_api_key)
         self.qa_engineer = QAEngineerAgent(model=self.model_backbone, notes=self.notes, max_steps=self.max_steps, openai_api_key=self.openai_api_key)
@@ -52,29 +84,143 @@ class AutomatedDevWorkflow:
         os.makedirs("./project_repo/tests", exist_ok=True)
         os.makedirs("./project_repo/docs", exist_ok=True)
     
+    def build_task_graph(self):
+        """
+        Build the subtask dependency graph from the phase list and declared dependencies.
+        """
+        graph = TaskGraph()
+        for _, subtasks in self.phases:
+            for subtask in subtasks:
+                graph.add_task(subtask, self.subtask_dependencies.get(subtask, []))
+        return graph
+
     def perform_development(self):
         """
         Execute the full development workflow.
+        Independent subtasks run concurrently on up to `max_workers` threads.
+        The run is traced as workflow -> phase -> subtask -> agent -> model call spans, written to
+        TRACE_PATH (JSONL) and METRICS_PATH (Prometheus text format) at the end.
         """
-        for phase, subtasks in self.phases:
-            phase_start_time = time.time()
-            print(f"Starting phase: {phase}")
-            for subtask in subtasks:
-                print(f"  -> Executing subtask: {subtask}")
-                self.execute_subtask(subtask)
-                self.phase_status[subtask] = True
-            phase_end_time = time.time()
-            phase_duration = phase_end_time - phase_start_time
-            print(f"Completed phase: {phase} in {phase_duration:.2f} seconds\n")
-            self.statistics_per_phase[phase] = {"time": phase_duration}
+        phase_of = {subtask: phase for phase, subtasks in self.phases for subtask in subtasks}
+        pending = {phase: set(subtasks) for phase, subtasks in self.phases}
+        timings = {}
+        # Subtasks executed in this run, as opposed to skipped because a resumed checkpoint completed them
+        ran = set()
+        # A phase span opens with the first of its subtasks to start, which may be on any worker thread
+        phase_spans = {}
+        phase_spans_lock = threading.Lock()
+
+        def phase_span(phase):
+            with phase_spans_lock:
+                if phase not in phase_spans:
+                    phase_spans[phase] = TRACER.start_span(phase, "phase", parent=workflow_span)
+                return phase_spans[phase]
+
+        def run_subtask(subtask):
+            start = time.time()
+            phase = phase_of[subtask]
+            with TRACER.span(subtask, "subtask", parent=phase_span(phase), phase=phase) as span:
+                if self.phase_status[subtask]:
+                    print(f"  -> Skipping completed subtask: {subtask} ({phase})")
+                    span.set(skipped=True)
+                else:
+                    print(f"  -> Executing subtask: {subtask} ({phase})")
+                    result_path = self.execute_subtask(subtask)
+                    self.completed_subtasks[subtask] = {"result_path": result_path, "result_sha256": _file_sha256(result_path),
+                                                        "time": time.time() - start}
+                    self.phase_status[subtask] = True
+                    steps = len(TRACER.descendants(span, "llm"))
+                    self.statistics_per_subtask[subtask] = {"time": time.time() - start, "steps": steps}
+                    span.set(steps=steps)
+                    ran.add(subtask)
+            timings[subtask] = (start, time.time())
+
+        def on_complete(subtask, _):
+            # This runs on the scheduling thread, one call at a time
+            phase = phase_of[subtask]
+            pending[phase].discard(subtask)
+            if not pending[phase]:
+                subtasks = dict(self.phases)[phase]
+                executed = [s for s in subtasks if s in ran]
+                if executed:
+                    # The phase time spans the first start to the last end of the subtasks run now,
+                    # plus the recorded time of subtasks a resumed checkpoint had already completed
+                    spans = [timings[s] for s in executed]
+                    phase_duration = max(end for _, end in spans) - min(start for start, _ in spans)
+                    phase_duration += sum(self.completed_subtasks[s].get("time", 0.0) for s in subtasks if s not in ran)
+                    steps = sum(self.statistics_per_subtask.get(s, {}).get("steps", 0) for s in subtasks)
+                    self.statistics_per_phase[phase] = {"time": phase_duration, "steps": steps}
+                    print(f"Completed phase: {phase} in {phase_duration:.2f} seconds\n")
+                else:
+                    # Every subtask was skipped: keep the statistics restored from the checkpoint
+                    print(f"Phase already completed: {phase}\n")
+                phase_spans[phase].set(steps=self.statistics_per_phase[phase]["steps"])
+                phase_spans[phase].finish()
+            # Checkpoint after every subtask, including the statistics of a phase it completed
+            self.save_checkpoint()
+
+        try:
+            with TRACER.span(self.project_name, "workflow") as workflow_span:
+                try:
+                    report = run_graph(self.build_task_graph(), run_subtask,
+                                       max_workers=self.max_workers, on_complete=on_complete)
+                finally:
+                    # Phases cut short by a failing subtask
+                    for span in phase_spans.values():
+                        span.finish()
+            print(f"Development finished: {report.summary()}")
+            return report
+        finally:
+            # A failing export must not hide the exception that ended the run
+            try:
+                TRACER.export_jsonl(TRACE_PATH)
+                TRACER.export_prometheus(METRICS_PATH)
+                print(TRACER.summary(10))
+            except Exception as e:
+                print(f"Could not export the trace: {e}")
+            # Each run exports only its own spans
+            TRACER.reset()
 
     def execute_subtask(self, subtask):
         agent = self.get_agent_for_subtask(subtask)
         if agent:
             subtask_data = {"name": subtask}  # ✅ Wrap subtask in a dictionary
-            result = agent.perform_task(self.project_name, subtask_data)
-            self.save_result(subtask, result)
+            # Streamed results are produced while they are saved, so saving stays inside the agent scope
+            with agent_scope(type(agent).__name__), TRACER.span(type(agent).__name__, "agent", subtask=subtask):
+                result = agent.perform_task(self.project_context(), subtask_data, stream=self.stream_results)
+                return self.save_result(subtask, result)
     
+    def load_reference_documents(self, paths, max_workers=None, max_tokens=800):
+        """
+        Extract the given PDFs on a process pool and add their text chunks to the reference documents.
+        @param paths: (list) Paths of the PDF files.
+        @param max_workers: (int) Number of extraction processes (default: one per CPU).
+        @param max_tokens: (int) Maximum size of each chunk in tokens.
+        """
+        ingestor = PdfIngestor(max_workers=max_workers)
+        chunks = ingestor.ingest(paths, max_tokens=max_tokens)
+        self.reference_documents.extend(chunks)
+        stats = ingestor.stats()
+        print(f"Ingested {stats['pages']} pages from {len(paths)} documents ({stats['cached_pages']} cached, "
+              f"{stats['failed_documents']} unreadable skipped) "
+              f"in {stats['seconds']:.2f} seconds, {stats['pages_per_second']:.1f} pages/sec, {len(chunks)} chunks")
+        return chunks
+
+    def project_context(self, max_tokens=REFERENCE_CONTEXT_TOKENS):
+        """
+        Return the project description followed by as many reference document chunks as fit in `max_tokens`.
+        """
+        if not self.reference_documents:
+            return self.project_name
+        excerpts, used = [], 0
+        for chunk in self.reference_documents:
+            tokens = cached_token_count(chunk["text"])
+            if used + tokens > max_tokens:
+                break
+            excerpts.append(f"[{os.path.basename(chunk['source'])} #{chunk['chunk']}]\n{chunk['text']}")
+            used += tokens
+        return f"{self.project_name}\n\nReference documents:\n" + "\n\n".join(excerpts)
+
     def get_agent_for_subtask(self, subtask):
         """
         Return the appropriate agent for a given subtask.
@@ -96,21 +242,126 @@ class AutomatedDevWorkflow:
     def save_result(self, subtask, result):
         """
         Save the results of a subtask.
+        `result` is either a string or an iterator of chunks, which is written to disk as it
+        arrives. The file is written under a temporary name and atomically renamed when complete,
+        so ./project_repo never contains a partial result.
+        """
+        path = f"./project_repo/{subtask.replace(' ', '_')}.txt"
+        tmp_path = f"{path}.part"
+        start_time = time.time()
+        written = 0
+        try:
+            with open(tmp_path, "w") as f:
+                if isinstance(result, str):
+                    f.write(result)
+                    written = len(result)
+                else:
+                    for chunk in result:
+                        if not written:
+                            print(f"    {subtask}: first output after {time.time() - start_time:.2f} seconds")
+                        f.write(chunk)
+                        f.flush()
+                        written += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if not isinstance(result, str):
+            print(f"    {subtask}: streamed {written} characters in {time.time() - start_time:.2f} seconds")
+        return path
+
+    def save_checkpoint(self, path=CHECKPOINT_PATH):
+        """
+        Persist workflow progress, completed subtask results and token counters.
+        The file is replaced atomically so an interrupted save never corrupts it.
         """
-        with open(f"./project_repo/{subtask.replace(' ', '_')}.txt", "w") as f:
-            f.write(result)
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "project_name": self.project_name,
+            "model_backbone": self.model_backbone,
+            "saved_at": time.time(),
+            "phase_status": dict(self.phase_status),
+            "completed_subtasks": dict(self.completed_subtasks),
+            "statistics_per_phase": dict(self.statistics_per_phase),
+            "statistics_per_subtask": dict(self.statistics_per_subtask),
+            "token_usage": TOKEN_ACCOUNTING.snapshot(),
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path=CHECKPOINT_PATH):
+        """
+        Restore progress from a checkpoint written by save_checkpoint().
+        Raises ValueError if it belongs to another project, model backbone or checkpoint version.
+        Subtasks whose result file is missing or was modified are run again.
+        Returns False if there is no checkpoint to resume from.
+        """
+        if not os.path.exists(path):
+            print(f"No checkpoint found at {path}, starting from scratch.")
+            return False
+        with open(path) as f:
+            checkpoint = json.load(f)
+        expected = {"version": CHECKPOINT_VERSION, "project_name": self.project_name, "model_backbone": self.model_backbone}
+        for field, value in expected.items():
+            if checkpoint.get(field) != value:
+                raise ValueError(f"Checkpoint {path} has {field}={checkpoint.get(field)!r}, expected {value!r}")
+        for subtask, info in checkpoint["completed_subtasks"].items():
+            if subtask not in self.phase_status:
+                continue
+            if _file_sha256(info["result_path"]) != info["result_sha256"]:
+                print(f"Result of '{subtask}' is missing or changed, it will be run again.")
+                continue
+            self.completed_subtasks[subtask] = info
+            self.phase_status[subtask] = True
+        # Older checkpoints keyed these statistics by subtask; only phase entries are kept
+        self.statistics_per_phase.update({phase: stats for phase, stats in checkpoint.get("statistics_per_phase", {}).items()
+                                          if phase in self.statistics_per_phase})
+        self.statistics_per_subtask.update({subtask: stats for subtask, stats in checkpoint.get("statistics_per_subtask", {}).items()
+                                            if subtask in self.statistics_per_subtask})
+        TOKEN_ACCOUNTING.restore(checkpoint.get("token_usage", []))
+        print(f"Resuming: {len(self.completed_subtasks)} of {len(self.phase_status)} subtasks already completed.")
+        return True
     
 
+def _file_sha256(path):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Automated Software Development Workflow")
     parser.add_argument('--project-name', type=str, required=True, help='Specify the software project name.')
     parser.add_argument('--api-key', type=str, required=True, help='Provide the OpenAI API key.')
+    parser.add_argument('--max-workers', type=int, default=4, help='Maximum number of subtasks run concurrently.')
+    parser.add_argument('--resume', action='store_true', help='Resume from the checkpoint in ./project_repo, skipping completed subtasks.')
+    parser.add_argument('--stream', action='store_true', help='Stream model output to ./project_repo as it is generated.')
+    parser.add_argument('--llm-cache', type=str, default=None, choices=["off", "readwrite", "readonly", "replay"],
+                        help='LLM response cache mode (default: $AUTODEV_LLM_CACHE or readwrite).')
+    parser.add_argument('--reference-docs', type=str, nargs='*', default=[], help='PDF files to extract and include as reference documents.')
+    parser.add_argument('--llm-cache-path', type=str, default=None, help='SQLite file for the LLM response cache.')
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = parse_arguments()
+    configure_cache(path=args.llm_cache_path, mode=args.llm_cache)
     workflow = AutomatedDevWorkflow(
         project_name=args.project_name,
-        openai_api_key=args.api_key
+        openai_api_key=args.api_key,
+        max_workers=args.max_workers,
+        stream_results=args.stream
     )
+    if args.reference_docs:
+        workflow.load_reference_documents(args.reference_docs)
+    if args.resume:
+        workflow.load_checkpoint()
     workflow.perform_development()
+    print(f"Token usage by agent: {token_usage(by='agent')}")
+    print(f"LLM cache: {cache_stats()}")
+    print(f"Provider prompt cache: {prompt_cache_stats()}")
+    print(f"Provider connections: {client_stats()}")
+    print(f"Provider rate limits: {rate_limit_stats()}")
+    print(f"Model routes: {route_stats()}")
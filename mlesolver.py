@@ -8,8 +8,15 @@ from copy import deepcopy
 from pathlib import Path
 from contextlib import contextmanager
 import sys
+import textwrap
+import statistics
+import threading
+import concurrent.futures
 
-from inference import query_model
+from inference import query_model, TOKEN_ACCOUNTING
+from tools import CodeExecutor
+from judge import ListwiseJudge
+from routing import route_query
 
 @contextmanager
 def suppress_stdout():
@@ -24,12 +31,18 @@ def suppress_stdout():
 logging.basicConfig(level=logging.WARNING)
 
 class AutomatedCodeRefinement:
-    def __init__(self, model, openai_api_key=None, max_attempts=3):
+    def __init__(self, model, openai_api_key=None, max_attempts=3, cascade=None):
         self.model = model
         self.openai_api_key = openai_api_key
         self.max_attempts = max_attempts
+        # Models tried in order until one returns a ```python block, e.g. ["gpt-4o-mini", "gpt-4o"]
+        self.cascade = cascade
 
-    def refine_code(self, code_snippet, error_message):
+    def refine_code(self, code_snippet, error_message, sample=None):
+        """
+        Ask the model for an improved version of `code_snippet`.
+        `sample` labels independent refinements of the same input so they are cached separately.
+        """
         system_prompt = """
         You are an AI-powered code refinement agent.
         Your goal is to analyze the provided code and error message,
@@ -38,13 +51,16 @@ class AutomatedCodeRefinement:
         Output the refined code wrapped in ```python.
         """
         for _ in range(self.max_attempts):
-            response = query_model(
-                model_str=self.model,
+            # Answers without a code block are not cached, so a retry asks the model again
+            fixed_code, _ = route_query(
+                self.cascade or [self.model],
                 system_prompt=system_prompt,
                 prompt=f"Error: {error_message}\n\nCode:\n{code_snippet}",
-                openai_api_key=self.openai_api_key
+                validator=self.extract_code,
+                route="refine_code",
+                openai_api_key=self.openai_api_key,
+                cache_salt=sample
             )
-            fixed_code = self.extract_code(response)
             if fixed_code:
                 return fixed_code
         return None
@@ -54,14 +70,149 @@ class AutomatedCodeRefinement:
         match = re.search(r"```python(.*?)```", response, re.DOTALL)
         return match.group(1).strip() if match else None
 
+# Appended to a candidate script: runs the harness `warmup` times, then `repeats` timed runs,
+# then one run under tracemalloc for peak memory, and prints the results as a marker line.
+_BENCHMARK_TEMPLATE = """
+{candidate}
+
+def __autodev_harness__():
+{harness}
+
+def __autodev_benchmark__():
+    import json as _json, time as _time, tracemalloc as _tracemalloc, traceback as _traceback
+    result = {{"times": [], "failures": 0, "error": None, "peak_memory": None}}
+    def _run():
+        try:
+            return __autodev_harness__() is not False
+        except Exception:
+            result["error"] = _traceback.format_exc(limit=3)
+            return False
+    for _ in range({warmup}):
+        _run()
+    for _ in range({repeats}):
+        start = _time.perf_counter()
+        passed = _run()
+        elapsed = _time.perf_counter() - start
+        if passed:
+            result["times"].append(elapsed)
+        else:
+            result["failures"] += 1
+    _tracemalloc.start()
+    if _run():
+        result["peak_memory"] = _tracemalloc.get_traced_memory()[1]
+    _tracemalloc.stop()
+    print("{marker}" + _json.dumps(result))
+
+__autodev_benchmark__()
+"""
+
+class ExecutionEvaluator:
+    """
+    Scores candidate scripts by running them against a benchmark harness with CodeExecutor.
+
+    The harness is Python code executed after the candidate, in the same namespace; a run
+    passes unless the harness raises or returns False. Each candidate gets `warmup` untimed
+    runs and `repeats` timed runs, plus one run under tracemalloc for peak memory.
+
+    The score is pass_rate * (time_weight * t_ref / (t_ref + t) + memory_weight * m_ref / (m_ref + m)),
+    where t and m are the median time and peak memory and the references are taken from the
+    first passing candidate. A candidate as fast as the reference scores 0.5, a faster one more.
+    """
+    MARKER = "@@AUTODEV_BENCHMARK@@"
+
+    def __init__(self, harness, repeats=5, warmup=1, timeout=60, time_weight=0.7, memory_weight=0.3,
+                 reference_time=None, reference_memory=None):
+        self.harness = harness
+        self.repeats = repeats
+        self.warmup = warmup
+        self.timeout = timeout
+        self.time_weight = time_weight
+        self.memory_weight = memory_weight
+        self.reference_time = reference_time
+        self.reference_memory = reference_memory
+        self.measurements = {}
+        self._lock = threading.Lock()
+
+    def measure(self, code):
+        """
+        Run `code` with the harness and return pass rate, median time, peak memory and any error.
+        """
+        script = _BENCHMARK_TEMPLATE.format(
+            candidate=code,
+            harness=textwrap.indent(textwrap.dedent(self.harness).strip() or "pass", "    "),
+            warmup=self.warmup, repeats=self.repeats, marker=self.MARKER,
+        )
+        # The report is the last line printed, so only a short head is needed besides the tail
+        output = CodeExecutor.execute(script, timeout=self.timeout, max_output_len=20000, head_len=1000)
+        reports = [line for line in output.splitlines() if line.startswith(self.MARKER)]
+        if not reports:
+            return {"passed": False, "pass_rate": 0.0, "time": None, "peak_memory": None, "error": output[-1000:]}
+        report = json.loads(reports[-1][len(self.MARKER):])
+        runs = len(report["times"]) + report["failures"]
+        return {
+            "passed": report["failures"] == 0,
+            "pass_rate": len(report["times"]) / runs if runs else 0.0,
+            "time": statistics.median(report["times"]) if report["times"] else None,
+            "peak_memory": report["peak_memory"],
+            "error": report["error"],
+        }
+
+    def score(self, code):
+        measurement = self.measure(code)
+        self.measurements[code] = measurement
+        if measurement["time"] is None:
+            return 0.0
+        with self._lock:
+            if self.reference_time is None:
+                self.reference_time = measurement["time"]
+            if self.reference_memory is None and measurement["peak_memory"]:
+                self.reference_memory = measurement["peak_memory"]
+        time_score = self.reference_time / (self.reference_time + measurement["time"]) if measurement["time"] else 1.0
+        memory = measurement["peak_memory"]
+        memory_score = self.reference_memory / (self.reference_memory + memory) if memory and self.reference_memory else 0.5
+        return measurement["pass_rate"] * (self.time_weight * time_score + self.memory_weight * memory_score)
+
 class MLESolver:
-    def __init__(self, model, openai_api_key=None, project_description="", max_steps=5):
+    def __init__(self, model, openai_api_key=None, project_description="", max_steps=5,
+                 beam_width=1, branching=1, max_workers=4, patience=None, min_improvement=1e-3,
+                 time_budget=None, token_budget=None, benchmark_harness=None, evaluator=None,
+                 judge_batch=8, cascade=None):
+        """
+        @param beam_width: (int) Number of top candidates kept after every step.
+        @param branching: (int) Refinements generated per kept candidate and step.
+        @param max_workers: (int) Concurrent refinement/evaluation calls.
+        @param patience: (int) Stop after this many steps without an improvement of `min_improvement`.
+        @param time_budget: (float) Stop starting new steps after this many seconds.
+        @param token_budget: (int) Stop starting new steps after this many input+output tokens.
+        @param benchmark_harness: (str) Python code exercising a candidate; when given, candidates are
+            scored by executing them (see ExecutionEvaluator) instead of asking the model.
+        @param evaluator: (ExecutionEvaluator) Preconfigured evaluator, overrides `benchmark_harness`.
+        @param judge_batch: (int) Candidates scored per model request when no evaluator is used.
+        @param cascade: (list) Models tried in order for refinement and judging, escalating to the
+            next one when an answer cannot be parsed, e.g. ["gpt-4o-mini", "gpt-4o"].
+        """
         self.model = model
         self.openai_api_key = openai_api_key
         self.project_description = project_description
         self.max_steps = max_steps
+        self.beam_width = beam_width
+        self.branching = branching
+        self.max_workers = max_workers
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.time_budget = time_budget
+        self.token_budget = token_budget
+        if evaluator is None and benchmark_harness is not None:
+            evaluator = ExecutionEvaluator(benchmark_harness)
+        self.evaluator = evaluator
+        self.judge = ListwiseJudge(
+            model, "Judge each machine learning script on correctness, efficiency, and alignment with the project description.",
+            context=f"Project Description:\n{project_description}", openai_api_key=openai_api_key,
+            max_batch=judge_batch, max_workers=max_workers, cascade=cascade)
+        self.cascade = cascade
         self.best_code = None
         self.best_score = 0
+        self.history = []
 
     def generate_initial_code(self):
         system_prompt = """
@@ -74,41 +225,86 @@ class MLESolver:
             model_str=self.model,
             system_prompt=system_prompt,
             prompt=self.project_description,
-            openai_api_key=self.openai_api_key
+            openai_api_key=self.openai_api_key,
+            cache_if=AutomatedCodeRefinement.extract_code
         )
-        return self.extract_code(response)
+        return AutomatedCodeRefinement.extract_code(response)
 
     def evaluate_code(self, code_snippet):
-        system_prompt = """
-        You are an AI-powered reviewer assessing the quality of a machine learning script.
-        Provide a score from 0 to 1 based on correctness, efficiency, and alignment with the project description.
-        Output only a numeric score.
+        return self.evaluate_codes([code_snippet])[0]
+
+    def evaluate_codes(self, candidates, executor=None):
         """
-        response = query_model(
-            model_str=self.model,
-            system_prompt=system_prompt,
-            prompt=f"Code:\n{code_snippet}\n\nProject Description:\n{self.project_description}",
-            openai_api_key=self.openai_api_key
-        )
-        try:
-            return float(response.strip())
-        except ValueError:
-            return 0
+        Score several candidates: by execution when an evaluator is configured (in parallel on
+        `executor`), otherwise with batched model judging, several candidates per request.
+        """
+        if self.evaluator is None:
+            return self.judge.score(candidates)
+        if executor is None:
+            return [self.evaluator.score(code) for code in candidates]
+        return list(executor.map(self.evaluator.score, candidates))
+
+    @staticmethod
+    def _tokens_used():
+        return sum(entry["in"] + entry["out"] for entry in TOKEN_ACCOUNTING.totals().values())
+
+    def _budget_exhausted(self, start_time, start_tokens):
+        if self.time_budget is not None and time.time() - start_time >= self.time_budget:
+            return "time budget"
+        if self.token_budget is not None and self._tokens_used() - start_tokens >= self.token_budget:
+            return "token budget"
+        return None
 
     def optimize_code(self):
+        """
+        Beam search over refinements: every step refines each of the `beam_width` best
+        candidates `branching` times in parallel, scores the new candidates in parallel and
+        keeps the best ones. Stops after `max_steps`, on a score plateau or when a budget runs out.
+        """
+        start_time, start_tokens = time.time(), self._tokens_used()
         initial_code = self.generate_initial_code()
         if not initial_code:
             return "Failed to generate initial code."
 
-        for _ in range(self.max_steps):
-            score = self.evaluate_code(initial_code)
-            if score > self.best_score:
-                self.best_code = initial_code
-                self.best_score = score
+        refinement_agent = AutomatedCodeRefinement(self.model, self.openai_api_key, cascade=self.cascade)
+        seen = {initial_code}
+        beam = [(self.evaluate_code(initial_code), initial_code)]
+        self.best_score, self.best_code = beam[0]
+        stale_steps = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for step in range(self.max_steps):
+                stop_reason = self._budget_exhausted(start_time, start_tokens)
+                if stop_reason:
+                    logging.info(f"Stopping search at step {step}: {stop_reason} exhausted")
+                    break
+
+                refinements = executor.map(
+                    lambda job: refinement_agent.refine_code(job[0], "Improve performance and correctness.",
+                                                             sample=f"step{step}-{job[1]}"),
+                    [(code, k) for _, code in beam for k in range(self.branching)]
+                )
+                candidates = []
+                for code in refinements:
+                    if code and code not in seen:
+                        seen.add(code)
+                        candidates.append(code)
+                scores = self.evaluate_codes(candidates, executor)
 
-            refinement_agent = AutomatedCodeRefinement(self.model, self.openai_api_key)
-            refined_code = refinement_agent.refine_code(initial_code, "Improve performance and correctness.")
-            if refined_code:
-                initial_code = refined_code
+                beam = sorted(beam + list(zip(scores, candidates)), key=lambda item: item[0], reverse=True)[:self.beam_width]
+                improved = beam[0][0] > self.best_score + self.min_improvement
+                if beam[0][0] > self.best_score:
+                    self.best_score, self.best_code = beam[0]
+                stale_steps = 0 if improved else stale_steps + 1
+                self.history.append({
+                    "step": step,
+                    "candidates": len(candidates),
+                    "best_score": self.best_score,
+                    "elapsed": time.time() - start_time,
+                    "tokens": self._tokens_used() - start_tokens,
+                })
+                if self.patience is not None and stale_steps >= self.patience:
+                    logging.info(f"Stopping search at step {step}: no improvement for {stale_steps} steps")
+                    break
 
         return self.best_code
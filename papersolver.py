@@ -1,16 +1,29 @@
 import random
 import re
 import os
-from inference import query_model
+import json
+import concurrent.futures
+from inference import query_model, TOKEN_ACCOUNTING
+from utils import compile_latex_many, cached_token_count
+from judge import ListwiseJudge
+
+# Section boundaries: every \section / \section* and the end of the document
+SECTION_PATTERN = re.compile(r"(?=\\section\*?\{)|(?=\\end\{document\})")
+SECTION_TITLE_PATTERN = re.compile(r"\\section\*?\{([^}]*)\}")
 
 class ResearchPaperGenerator:
-    def __init__(self, model, openai_api_key=None, project_topic="", max_steps=3):
+    def __init__(self, model, openai_api_key=None, project_topic="", max_steps=3, max_workers=4):
         self.model = model
         self.openai_api_key = openai_api_key
         self.project_topic = project_topic
         self.max_steps = max_steps
+        self.max_workers = max_workers
         self.best_paper = None
         self.best_score = 0
+        self.step_metrics = []
+        self.judge = ListwiseJudge(
+            model, "Judge each research paper on clarity, scientific merit, and completeness.",
+            context=f"Topic:\n{project_topic}", openai_api_key=openai_api_key, max_workers=max_workers)
 
     def generate_initial_paper(self):
         system_prompt = """
@@ -23,26 +36,29 @@ class ResearchPaperGenerator:
             model_str=self.model,
             system_prompt=system_prompt,
             prompt=self.project_topic,
-            openai_api_key=self.openai_api_key
+            openai_api_key=self.openai_api_key,
+            cache_if=self.extract_latex
         )
         return self.extract_latex(response)
 
+    def _query_usage(self, **kwargs):
+        """
+        query_model() with this generator's model. Returns (response, tokens sent and received),
+        as reported by the provider for this call (0 for a response-cache hit).
+        """
+        before = TOKEN_ACCOUNTING.thread_usage(self.model)
+        response = query_model(model_str=self.model, openai_api_key=self.openai_api_key, **kwargs)
+        after = TOKEN_ACCOUNTING.thread_usage(self.model)
+        return response, {"in": after["in"] - before["in"], "out": after["out"] - before["out"]}
+
     def evaluate_paper(self, paper_content):
-        system_prompt = """
-        You are an AI-powered research reviewer assessing a generated paper.
-        Provide a score from 0 to 1 based on clarity, scientific merit, and completeness.
-        Output only a numeric score.
+        return self.evaluate_papers([paper_content])[0]
+
+    def evaluate_papers(self, papers):
         """
-        response = query_model(
-            model_str=self.model,
-            system_prompt=system_prompt,
-            prompt=f"Paper Content:\n{paper_content}\n\nTopic:\n{self.project_topic}",
-            openai_api_key=self.openai_api_key
-        )
-        try:
-            return float(response.strip())
-        except ValueError:
-            return 0
+        Score several candidate papers, several per model request.
+        """
+        return self.judge.score(papers)
 
     def refine_paper(self, paper_content, feedback="Improve clarity and completeness."):
         system_prompt = """
@@ -55,27 +71,145 @@ class ResearchPaperGenerator:
             model_str=self.model,
             system_prompt=system_prompt,
             prompt=f"Feedback: {feedback}\n\nPaper:\n{paper_content}",
-            openai_api_key=self.openai_api_key
+            openai_api_key=self.openai_api_key,
+            cache_if=self.extract_latex
         )
         return self.extract_latex(response)
 
+    @staticmethod
+    def split_sections(paper):
+        """
+        Split a LaTeX paper into a list of {"title", "text"} segments: the preamble, one segment
+        per \\section (including its subsections) and the closing part. Joining the texts gives
+        back the original paper.
+        """
+        sections = []
+        for text in SECTION_PATTERN.split(paper):
+            if not text:
+                continue
+            match = SECTION_TITLE_PATTERN.match(text)
+            title = match.group(1).strip() if match else ("preamble" if not sections else "closing")
+            sections.append({"title": title, "text": text})
+        return sections
+
+    def evaluate_sections(self, sections):
+        """
+        Score the paper and flag the sections that need work.
+        Returns (score, {section index: feedback}, {"in": tokens sent, "out": tokens received}).
+        """
+        system_prompt = """
+        You are an AI-powered research reviewer assessing a generated paper.
+        The paper is split into numbered sections. Score the whole paper from 0 to 1 based on
+        clarity, scientific merit, and completeness, and list only the sections that should be revised.
+        Output only JSON of the form:
+        {"score": 0.7, "flagged": [{"section": 2, "feedback": "what to improve"}]}
+        """
+        paper = "\n".join(f"%% Section {i}: {section['title']}\n{section['text']}" for i, section in enumerate(sections))
+        response, usage = self._query_usage(
+            system_prompt=system_prompt,
+            prompt=f"Paper Content:\n{paper}\n\nTopic:\n{self.project_topic}"
+        )
+        match = re.search(r"\{.*\}", response, re.DOTALL)
+        try:
+            review = json.loads(match.group(0))
+            flagged = {int(item["section"]): str(item.get("feedback") or "Improve clarity and completeness.")
+                       for item in review.get("flagged", []) if 0 <= int(item["section"]) < len(sections)}
+            return min(max(float(review["score"]), 0.0), 1.0), flagged, usage
+        except (AttributeError, ValueError, KeyError, TypeError):
+            # Unparseable review: fall back to revising every section with the generic feedback.
+            # Only a number labelled as the score counts; others are usually section numbers
+            number = re.search(r"score\W*(\d*\.?\d+)", response, re.I)
+            score = min(float(number.group(1)), 1.0) if number else 0.0
+            return score, {i: "Improve clarity and completeness." for i, section in enumerate(sections)
+                           if section["title"] not in ("preamble", "closing")}, usage
+
+    def refine_section(self, sections, index, feedback):
+        """
+        Refine one section. Only the section itself and the outline of the paper are sent.
+        Returns (text, tokens sent and received).
+        """
+        system_prompt = """
+        You are an AI-powered research paper refinement assistant.
+        Your goal is to enhance one section of a paper based on feedback.
+        Ensure readability, coherence with the rest of the paper, and scientific validity.
+        Output only the improved section, starting with its \\section command, wrapped in ```latex.
+        """
+        outline = "\n".join(f"{i}. {section['title']}" for i, section in enumerate(sections))
+        prompt = (f"Topic: {self.project_topic}\n\nPaper outline:\n{outline}\n\nFeedback: {feedback}\n\n"
+                  f"Section {index}:\n{sections[index]['text']}")
+        response, usage = self._query_usage(
+            system_prompt=system_prompt,
+            prompt=prompt,
+            cache_if=self.extract_latex
+        )
+        refined = self.extract_latex(response)
+        tokens = usage["in"] + usage["out"]
+        if not refined:
+            return sections[index]["text"], tokens
+        # Keep the separating whitespace of the original section so splicing preserves the layout
+        trailing = sections[index]["text"][len(sections[index]["text"].rstrip()):]
+        return refined.rstrip() + (trailing or "\n"), tokens
+
+    def refine_sections(self, paper, flagged):
+        """
+        Refine the flagged sections concurrently and splice them back into the paper.
+        Returns (paper, tokens sent and received).
+        """
+        sections = self.split_sections(paper)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(flagged)))) as executor:
+            futures = {index: executor.submit(self.refine_section, sections, index, feedback)
+                       for index, feedback in flagged.items()}
+            tokens = 0
+            for index, future in futures.items():
+                text, used = future.result()
+                sections[index] = dict(sections[index], text=text)
+                tokens += used
+        return "".join(section["text"] for section in sections), tokens
+
     def optimize_paper(self):
         initial_paper = self.generate_initial_paper()
         if not initial_paper:
             return "Failed to generate initial paper."
 
-        for _ in range(self.max_steps):
-            score = self.evaluate_paper(initial_paper)
+        for step in range(self.max_steps):
+            sections = self.split_sections(initial_paper)
+            score, flagged, evaluation = self.evaluate_sections(sections)
             if score > self.best_score:
                 self.best_paper = initial_paper
                 self.best_score = score
+            if not flagged:
+                break
 
-            refined_paper = self.refine_paper(initial_paper)
-            if refined_paper:
-                initial_paper = refined_paper
+            # A full-paper refinement would send the whole paper, as the evaluator just did, and receive
+            # it back; the paper is tokenized locally only when the evaluation was a cache hit
+            paper_tokens = evaluation["in"] or cached_token_count(initial_paper, self.model)
+            full_tokens = 2 * paper_tokens
+            initial_paper, refinement_tokens = self.refine_sections(initial_paper, flagged)
+            # The section evaluator reads the whole paper every step, so its tokens count against the savings
+            tokens = evaluation["in"] + evaluation["out"] + refinement_tokens
+            self.step_metrics.append({
+                "step": step,
+                "score": score,
+                "sections": len(sections),
+                "refined_sections": len(flagged),
+                "evaluation_tokens": evaluation["in"] + evaluation["out"],
+                "refinement_tokens": refinement_tokens,
+                "tokens": tokens,
+                "full_paper_tokens": full_tokens,
+                "tokens_saved": full_tokens - tokens,
+            })
+            print(f"Step {step}: refined {len(flagged)}/{len(sections)} sections, {tokens} tokens including "
+                  f"evaluation ({full_tokens - tokens} saved versus full-paper refinement)")
 
         return self.best_paper
 
+    def compile_papers(self, papers, max_workers=4):
+        """
+        Compile candidate papers in parallel. Returns a list of (compiled, message) pairs.
+        """
+        results = compile_latex_many(papers, max_workers=max_workers)
+        return [(not result.startswith("[ERROR]"), result) for result in results]
+
     @staticmethod
     def extract_latex(response):
         match = re.search(r"```latex(.*?)```", response, re.DOTALL)
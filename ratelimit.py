@@ -0,0 +1,311 @@
+import os
+import time
+import random
+import threading
+
+
+class CircuitOpenError(Exception):
+    """Raised without contacting the provider while its circuit breaker is open."""
+
+
+class RetriesExhaustedError(Exception):
+    """Raised when every attempt of a request failed with a retryable error."""
+
+
+# Status codes worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = {408, 409, 429}
+
+# Programming and configuration errors never succeed on a retry
+FATAL_ERRORS = (ValueError, TypeError, KeyError, AttributeError, NotImplementedError)
+
+
+def _retry_after(error):
+    """Return the server-requested delay in seconds from the error's response headers, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return max(float(headers["retry-after-ms"]) / 1000, 0.0)
+        if headers.get("retry-after") is not None:
+            return max(float(headers["retry-after"]), 0.0)
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def classify_error(error):
+    """
+    Return (retryable, rate_limited, retry_after) for an exception raised by a provider call.
+    HTTP errors are classified by status code; connection errors and timeouts are retryable;
+    ValueError and other programming errors are fatal. Unknown errors are retried.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(status, int):
+        retryable = status in RETRYABLE_STATUS or status >= 500
+        return retryable, status == 429, _retry_after(error)
+    if isinstance(error, FATAL_ERRORS):
+        return False, False, None
+    return True, False, None
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0, retry_after=None):
+    """
+    Exponential backoff with full jitter: a random delay in [0, min(cap, base * 2**attempt)].
+    A server-provided `retry_after` is a lower bound, with a little jitter added so that
+    clients told to wait the same time do not all retry at once.
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after + random.uniform(0, min(1.0, base)))
+    return delay
+
+
+class AdaptiveRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter shared by every caller of one provider.
+
+    Both budgets are token buckets refilled continuously. reserve() books capacity and returns
+    how long the caller must wait before sending, so waiting works for threads and coroutines
+    alike. A 429 halves the current rates and pauses the provider for its Retry-After; every
+    success raises them again by a small step until the configured limits are reached.
+    """
+    def __init__(self, rpm, tpm, min_fraction=0.05, recovery=0.05):
+        self.max_rpm = rpm
+        self.max_tpm = tpm
+        self.rpm = rpm
+        self.tpm = tpm
+        self.min_fraction = min_fraction
+        self.recovery = recovery
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waited = 0.0
+        self.rate_limited = 0
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def reserve(self, tokens=0):
+        """
+        Book one request of about `tokens` tokens and return the seconds to wait before sending it.
+        Bookings may overdraw the buckets; later callers then wait for the refill.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            tokens = min(tokens, self.tpm)
+            self._requests -= 1
+            self._tokens -= tokens
+            wait = max(-self._requests * 60 / self.rpm, -self._tokens * 60 / self.tpm if self.tpm else 0.0,
+                       self._paused_until - now, 0.0)
+            self.waited += wait
+            return wait
+
+    def record_usage(self, tokens):
+        """Charge tokens that were not known when the request was reserved (e.g. the output)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= tokens
+
+    def on_rate_limited(self, retry_after=None):
+        with self._lock:
+            self.rate_limited += 1
+            self.rpm = max(self.rpm / 2, self.max_rpm * self.min_fraction)
+            self.tpm = max(self.tpm / 2, self.max_tpm * self.min_fraction)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def on_success(self):
+        with self._lock:
+            self.rpm = min(self.max_rpm, self.rpm + self.max_rpm * self.recovery)
+            self.tpm = min(self.max_tpm, self.tpm + self.max_tpm * self.recovery)
+
+    def stats(self):
+        with self._lock:
+            return {"rpm": self.rpm, "tpm": self.tpm, "max_rpm": self.max_rpm, "max_tpm": self.max_tpm,
+                    "rate_limited": self.rate_limited, "waited": self.waited}
+
+
+class CircuitBreaker:
+    """
+    Fails fast when a provider keeps failing.
+
+    After `failure_threshold` consecutive retryable failures the circuit opens and calls raise
+    CircuitOpenError immediately. After `reset_timeout` seconds one probe call is let through
+    (half-open); its success closes the circuit, its failure opens it again. A probe that is not
+    settled within another `reset_timeout` seconds counts as failed, so a lost probe cannot
+    keep the circuit half-open forever.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Return True if this call is the half-open probe; raises CircuitOpenError while the circuit is open."""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half-open" and now - self.probe_started >= self.reset_timeout:
+                # The probe never reported back
+                self.state = "open"
+                self.opened_at = now
+            if self.state == "open":
+                if now - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(f"Circuit open after {self.failures} consecutive failures; "
+                                           f"retrying in {self.reset_timeout - (now - self.opened_at):.1f}s")
+                self.state = "half-open"
+                self.probe_started = now
+                return True
+            if self.state == "half-open":
+                # A probe is already in flight
+                self.rejected += 1
+                raise CircuitOpenError("Circuit half-open, waiting for the probe request")
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def release(self):
+        """Re-close a half-open circuit whose probe showed the provider is reachable but failed otherwise."""
+        with self._lock:
+            if self.state == "half-open":
+                self.state = "closed"
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class ProviderGuard:
+    """
+    Rate limiter and circuit breaker of one provider, plus the retry policy that drives them.
+    """
+    def __init__(self, provider, rpm, tpm, failure_threshold=5, reset_timeout=30.0):
+        self.provider = provider
+        self.limiter = AdaptiveRateLimiter(rpm, tpm)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.retries = 0
+        self.fatal = 0
+
+    def before_attempt(self, tokens=0):
+        """
+        Return (wait, probe): the seconds to wait before sending, and whether the attempt is the
+        breaker's half-open probe. Raises CircuitOpenError while the provider is down.
+        Every attempt must end in on_success(), on_failure() or abandon().
+        """
+        probe = self.breaker.before_call()
+        return self.limiter.reserve(tokens), probe
+
+    def on_success(self, output_tokens=0):
+        self.breaker.record_success()
+        self.limiter.on_success()
+        if output_tokens:
+            self.limiter.record_usage(output_tokens)
+
+    def on_failure(self, error, attempt, tries, base_delay=1.0):
+        """
+        Return the seconds to sleep before the next attempt. Re-raises `error` when it is fatal
+        and raises RetriesExhaustedError after the last attempt.
+        """
+        retryable, rate_limited, retry_after = classify_error(error)
+        if not retryable:
+            self.fatal += 1
+            self.breaker.release()
+            raise error
+        if rate_limited:
+            # The provider is up, only busy: slow down without tripping the breaker
+            self.limiter.on_rate_limited(retry_after)
+            self.breaker.release()
+        else:
+            self.breaker.record_failure()
+        if attempt + 1 >= tries:
+            raise RetriesExhaustedError(f"Max retries reached: {error}") from error
+        self.retries += 1
+        return backoff_delay(attempt, base_delay, retry_after=retry_after)
+
+    def abandon(self, probe, error=None):
+        """
+        Settle an attempt that ended without on_success() or on_failure(): a stream that broke
+        after its first chunk (`error`), or a caller that was cancelled or stopped reading.
+        """
+        retryable, rate_limited, _ = classify_error(error) if error is not None else (False, False, None)
+        if retryable and not rate_limited:
+            self.breaker.record_failure()
+        elif probe:
+            self.breaker.release()
+
+    def stats(self):
+        return {"provider": self.provider, "retries": self.retries, "fatal": self.fatal,
+                **self.limiter.stats(), "breaker": self.breaker.stats()}
+
+
+# Default limits per provider, overridable with AUTODEV_<PROVIDER>_RPM / AUTODEV_<PROVIDER>_TPM
+DEFAULT_LIMITS = {
+    "openai": (500, 200000),
+    "anthropic": (50, 40000),
+}
+
+_GUARDS = {}
+_GUARDS_LOCK = threading.Lock()
+
+
+def _make_guard(provider, rpm=None, tpm=None, failure_threshold=None, reset_timeout=None):
+    default_rpm, default_tpm = DEFAULT_LIMITS.get(provider, DEFAULT_LIMITS["openai"])
+    return ProviderGuard(
+        provider,
+        rpm or int(os.getenv(f"AUTODEV_{provider.upper()}_RPM", default_rpm)),
+        tpm or int(os.getenv(f"AUTODEV_{provider.upper()}_TPM", default_tpm)),
+        failure_threshold=failure_threshold or 5,
+        reset_timeout=reset_timeout or 30.0,
+    )
+
+
+def configure_rate_limits(provider, rpm=None, tpm=None, failure_threshold=None, reset_timeout=None):
+    """
+    Replace the guard of `provider` with one using the given limits (unset values keep the defaults).
+    """
+    guard = _make_guard(provider, rpm, tpm, failure_threshold, reset_timeout)
+    with _GUARDS_LOCK:
+        _GUARDS[provider] = guard
+    return guard
+
+
+def provider_guard(provider):
+    """Return the process-wide guard of `provider`, creating it on first use."""
+    guard = _GUARDS.get(provider)
+    if guard is None:
+        with _GUARDS_LOCK:
+            guard = _GUARDS.get(provider)
+            if guard is None:
+                guard = _GUARDS[provider] = _make_guard(provider)
+    return guard
+
+
+def rate_limit_stats():
+    with _GUARDS_LOCK:
+        guards = list(_GUARDS.values())
+    return [guard.stats() for guard in guards]
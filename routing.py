@@ -0,0 +1,118 @@
+import re
+import time
+import threading
+
+from inference import query_model, estimate_cost, TOKEN_ACCOUNTING
+from utils import extract_json_between_markers
+
+
+def score_validator(response):
+    """Accept a response containing a number in [0, 1]; return it as a float."""
+    match = re.search(r"-?\d*\.?\d+", response)
+    if match is None:
+        return None
+    score = float(match.group(0))
+    return score if 0.0 <= score <= 1.0 else None
+
+
+def json_validator(response):
+    """Accept a response containing a JSON object; return the parsed object."""
+    return extract_json_between_markers(response)
+
+
+class RouteStats:
+    """
+    Counters of one route: how often each model of the cascade was tried and accepted,
+    the time spent on it and its estimated cost.
+    """
+    def __init__(self, name, models):
+        self.name = name
+        self.models = list(models)
+        self.calls = 0
+        self.escalations = 0
+        self.failures = 0
+        self.per_model = {model: {"calls": 0, "accepted": 0, "latency": 0.0, "cost": 0.0} for model in self.models}
+        self._lock = threading.Lock()
+
+    def record_attempt(self, model, accepted, latency, cost):
+        with self._lock:
+            entry = self.per_model.setdefault(model, {"calls": 0, "accepted": 0, "latency": 0.0, "cost": 0.0})
+            entry["calls"] += 1
+            entry["accepted"] += int(accepted)
+            entry["latency"] += latency
+            entry["cost"] += cost
+
+    def record_call(self, attempts, accepted):
+        with self._lock:
+            self.calls += 1
+            self.escalations += int(attempts > 1)
+            self.failures += int(not accepted)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "route": self.name,
+                "calls": self.calls,
+                "escalation_rate": self.escalations / self.calls if self.calls else 0.0,
+                "failure_rate": self.failures / self.calls if self.calls else 0.0,
+                "cost": sum(entry["cost"] for entry in self.per_model.values()),
+                "models": {
+                    model: {
+                        "calls": entry["calls"],
+                        "acceptance_rate": entry["accepted"] / entry["calls"] if entry["calls"] else 0.0,
+                        "mean_latency": entry["latency"] / entry["calls"] if entry["calls"] else 0.0,
+                        "cost": entry["cost"],
+                    }
+                    for model, entry in self.per_model.items()
+                },
+            }
+
+
+_ROUTES = {}
+_ROUTES_LOCK = threading.Lock()
+
+
+def _route(name, models):
+    with _ROUTES_LOCK:
+        stats = _ROUTES.get(name)
+        if stats is None:
+            stats = _ROUTES[name] = RouteStats(name, models)
+        return stats
+
+
+def route_query(models, prompt, system_prompt, validator, route=None, **kwargs):
+    """
+    Query the models of a cascade in order until one answer passes `validator`.
+
+    `validator(response)` returns the parsed value, or None to reject the response and
+    escalate to the next model. Returns (value, model) for the first accepted answer, or
+    (None, last model) if every model was rejected. Extra keyword arguments go to query_model.
+    Rejected answers are kept out of the response cache, so a rerun asks the model again.
+    Statistics are kept per `route` (default: the cascade itself, e.g. "gpt-4o-mini>gpt-4o").
+    Costs come from the usage each call recorded, so response-cache hits are free and provider
+    prompt-cache discounts are applied.
+    """
+    models = list(models)
+    stats = _route(route or ">".join(models), models)
+    kwargs.setdefault("cache_if", lambda response: validator(response) is not None)
+    value, attempts = None, 0
+    for model in models:
+        attempts += 1
+        start = time.time()
+        before = TOKEN_ACCOUNTING.thread_usage(model)
+        response = query_model(model_str=model, prompt=prompt, system_prompt=system_prompt, **kwargs)
+        used = {field: value - before[field] for field, value in TOKEN_ACCOUNTING.thread_usage(model).items()}
+        value = validator(response)
+        cost = estimate_cost(model, used["in"], used["out"], used["cached_in"], used["cache_write_in"])
+        stats.record_attempt(model, value is not None, time.time() - start, cost)
+        if value is not None:
+            break
+    stats.record_call(attempts, value is not None)
+    return value, model
+
+
+def route_stats():
+    """Return escalation rate, latency and estimated cost of every route used so far."""
+    with _ROUTES_LOCK:
+        routes = list(_ROUTES.values())
+    return [stats.snapshot() for stats in routes]
@@ -0,0 +1,147 @@
+import time
+import threading
+import contextvars
+import concurrent.futures
+
+
+class TaskGraph:
+    """
+    Directed acyclic graph of named tasks with declared dependencies.
+    """
+    def __init__(self):
+        self.dependencies = {}
+
+    def add_task(self, name, depends_on=()):
+        if name in self.dependencies:
+            raise ValueError(f"Duplicate task: {name}")
+        self.dependencies[name] = list(depends_on)
+
+    def dependents(self):
+        """Return a mapping from each task to the tasks that depend on it."""
+        children = {name: [] for name in self.dependencies}
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                children[dep].append(name)
+        return children
+
+    def topological_order(self):
+        """
+        Return the tasks in dependency order (declaration order among ready tasks).
+        Raises ValueError on unknown dependencies or cycles.
+        """
+        for name, deps in self.dependencies.items():
+            unknown = [d for d in deps if d not in self.dependencies]
+            if unknown:
+                raise ValueError(f"Task '{name}' depends on unknown tasks: {unknown}")
+        remaining = {name: len(deps) for name, deps in self.dependencies.items()}
+        children = self.dependents()
+        ready = [name for name, count in remaining.items() if count == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for child in children[name]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    ready.append(child)
+        if len(order) != len(self.dependencies):
+            cyclic = sorted(name for name in self.dependencies if name not in order)
+            raise ValueError(f"Dependency cycle between tasks: {cyclic}")
+        return order
+
+    def critical_path(self, durations):
+        """
+        Return (path, length) of the longest dependency chain weighted by `durations`.
+        """
+        finish, previous = {}, {}
+        for name in self.topological_order():
+            best_dep = max(self.dependencies[name], key=lambda d: finish[d], default=None)
+            start = finish[best_dep] if best_dep is not None else 0.0
+            finish[name] = start + durations.get(name, 0.0)
+            previous[name] = best_dep
+        if not finish:
+            return [], 0.0
+        node = max(finish, key=finish.get)
+        length = finish[node]
+        path = []
+        while node is not None:
+            path.append(node)
+            node = previous[node]
+        return path[::-1], length
+
+
+class ScheduleReport:
+    """
+    Results and timings of one TaskGraph execution.
+    """
+    def __init__(self, results, timings, critical_path, critical_path_time, wall_time):
+        self.results = results
+        self.timings = timings
+        self.critical_path = critical_path
+        self.critical_path_time = critical_path_time
+        self.wall_time = wall_time
+
+    @property
+    def serial_time(self):
+        """Sum of all task durations, i.e. the wall time of a one-at-a-time run."""
+        return sum(end - start for start, end in self.timings.values())
+
+    def summary(self):
+        return (f"wall time {self.wall_time:.2f}s, serial time {self.serial_time:.2f}s, "
+                f"critical path {self.critical_path_time:.2f}s: {' -> '.join(self.critical_path)}")
+
+
+def run_graph(graph, run_task, max_workers=4, on_complete=None):
+    """
+    Execute every task of `graph` as `run_task(name)` on a bounded thread pool.
+    A task starts as soon as all of its dependencies have finished. `on_complete(name, result)`
+    is called from the scheduling thread after each task. If a task raises, no new tasks are
+    started, running ones are allowed to finish and the first exception is re-raised.
+    Each task runs in a copy of the caller's context, so context variables (the current trace
+    span, the agent scope) carry over into the worker threads.
+    """
+    order = graph.topological_order()
+    children = graph.dependents()
+    remaining = {name: len(graph.dependencies[name]) for name in order}
+    results, timings = {}, {}
+    timings_lock = threading.Lock()
+
+    def timed(name):
+        start = time.time()
+        try:
+            return run_task(name)
+        finally:
+            with timings_lock:
+                timings[name] = (start, time.time())
+
+    def submit(executor, name):
+        return executor.submit(contextvars.copy_context().run, timed, name)
+
+    wall_start = time.time()
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        for name in order:
+            if remaining[name] == 0:
+                running[submit(executor, name)] = name
+        while running:
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if on_complete is not None:
+                    on_complete(name, results[name])
+                if error is not None:
+                    continue
+                for child in children[name]:
+                    remaining[child] -= 1
+                    if remaining[child] == 0:
+                        running[submit(executor, child)] = child
+    if error is not None:
+        raise error
+    path, path_time = graph.critical_path({name: end - start for name, (start, end) in timings.items()})
+    return ScheduleReport(results, timings, path, path_time, time.time() - wall_start)
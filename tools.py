@@ -3,63 +3,904 @@ import os
 import re
 import io
 import sys
+import json
+import mmap
+import shutil
+import hashlib
+import argparse
+import tempfile
+import queue
+import random
+import atexit
+import logging
+import collections
+import threading
 import traceback
-import numpy as np
+import multiprocessing
 import concurrent.futures
-from pypdf import PdfReader
-from datasets import load_dataset, load_dataset_builder
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
-from semanticscholar import SemanticScholar
+from common_imports import lazy_import
+from llm_cache import ResponseCache
+from utils import chunk_text
+
+# Heavy dependencies are resolved on first use so importing the agents stays cheap.
+np = lazy_import("numpy")
+PdfReader = lazy_import("pypdf", "PdfReader")
+load_dataset = lazy_import("datasets", "load_dataset")
+load_dataset_builder = lazy_import("datasets", "load_dataset_builder")
+TfidfVectorizer = lazy_import("sklearn.feature_extraction.text", "TfidfVectorizer")
+linear_kernel = lazy_import("sklearn.metrics.pairwise", "linear_kernel")
+sparse = lazy_import("scipy.sparse")
+requests = lazy_import("requests")
+
+DATASET_NAME = "nkasmanoff/huggingface-datasets"
+DATASET_INDEX_DIR = os.getenv("AUTODEV_DATASET_INDEX", os.path.join(os.path.expanduser("~"), ".cache", "autodev", "dataset_index"))
+DATASET_INDEX_VERSION = 2
+
+class _RecordStore:
+    """
+    Read-only sequence of JSON records stored one per line, decoded on access.
+    The file is memory-mapped, so only the records that are actually returned get parsed.
+    """
+    def __init__(self, path, offsets):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if offsets[-1] else b""
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._map[int(self._offsets[i]):int(self._offsets[i + 1])])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+def _to_number(value):
+    """Return `value` as a float, or None if it is missing or not numeric."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Marks a filter argument that was not passed, since None disables a filter
+_DEFAULT = object()
+
+class DatasetIndex:
+    """
+    On-disk TF-IDF index over every dataset: vocabulary, IDF weights, the CSR document matrix,
+    the records, and numeric metadata (likes, downloads, ...) as one column per field aligned
+    with the matrix rows. Arrays are loaded with numpy memory mapping, so opening an index is
+    cheap and every process using it shares the same page-cache pages.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != DATASET_INDEX_VERSION:
+            raise ValueError(f"Dataset index at {path} has version {self.meta.get('version')}, expected {DATASET_INDEX_VERSION}")
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.matrix = sparse.csr_matrix((load("data"), load("indices"), load("indptr")),
+                                        shape=tuple(self.meta["shape"]), copy=False)
+        self.idf = load("idf")
+        self.records = _RecordStore(os.path.join(path, "records.jsonl"), load("offsets"))
+        self.columns = {name: load(f"column_{name}") for name in self.meta["columns"]}
+        self._vectorizer = None
+
+    @property
+    def vectorizer(self):
+        """The fitted TfidfVectorizer, rebuilt from the stored vocabulary and IDF on first use."""
+        if self._vectorizer is None:
+            with open(os.path.join(self.path, "vocabulary.json")) as f:
+                vectorizer = TfidfVectorizer(vocabulary=json.load(f))
+            vectorizer.idf_ = np.asarray(self.idf)
+            self._vectorizer = vectorizer
+        return self._vectorizer
+
+    @staticmethod
+    def build(path, records, fingerprint, params):
+        """
+        Fit TF-IDF on the records' descriptions and write the index to `path` atomically.
+        Every field with at least one numeric value is stored as a float64 column, with NaN for
+        values that are missing or do not parse as numbers.
+        """
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent, prefix=".building-")
+        descriptions, offsets, columns = [], [0], {}
+        with open(os.path.join(tmp_path, "records.jsonl"), "wb") as f:
+            for row, record in enumerate(records):
+                descriptions.append(record.get("description") or "")
+                for name, value in record.items():
+                    if name not in columns:
+                        columns[name] = [np.nan] * row
+                    number = _to_number(value)
+                    columns[name].append(np.nan if number is None else number)
+                for values in columns.values():
+                    if len(values) <= row:
+                        values.append(np.nan)
+                line = json.dumps(record, default=str).encode("utf-8") + b"\n"
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.save(os.path.join(tmp_path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+        columns = {name: np.asarray(values, dtype=np.float64) for name, values in columns.items()}
+        columns = {name: column for name, column in columns.items() if not np.isnan(column).all()}
+        for name, column in columns.items():
+            np.save(os.path.join(tmp_path, f"column_{name}.npy"), column)
+
+        vectorizer = TfidfVectorizer()
+        matrix = vectorizer.fit_transform(descriptions).tocsr()
+        np.save(os.path.join(tmp_path, "data.npy"), matrix.data)
+        np.save(os.path.join(tmp_path, "indices.npy"), matrix.indices)
+        np.save(os.path.join(tmp_path, "indptr.npy"), matrix.indptr)
+        np.save(os.path.join(tmp_path, "idf.npy"), vectorizer.idf_)
+        with open(os.path.join(tmp_path, "vocabulary.json"), "w") as f:
+            json.dump({term: int(i) for term, i in vectorizer.vocabulary_.items()}, f)
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"version": DATASET_INDEX_VERSION, "fingerprint": fingerprint, "params": params,
+                       "shape": list(matrix.shape), "columns": sorted(columns), "built_at": time.time()}, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
 
 class DatasetSearcher:
-    def __init__(self, min_likes=3, min_downloads=50):
+    def __init__(self, min_likes=3, min_downloads=50, index_dir=DATASET_INDEX_DIR, rebuild=False, index=None):
+        """
+        Open the persistent TF-IDF index, building it on first use.
+        The index covers every dataset; `min_likes` and `min_downloads` are only the default
+        filters applied at query time (None disables one), and each search can override them without a rebuild.
+        `rebuild=True` reloads the dataset and refits the index; `index` uses an already opened DatasetIndex.
+        """
         self.min_likes = min_likes
         self.min_downloads = min_downloads
-        self.datasets = load_dataset("nkasmanoff/huggingface-datasets")["train"]
-        self.filtered_datasets = self._filter_datasets()
-        self.vectorizer = TfidfVectorizer()
-        self.dataset_vectors = self.vectorizer.fit_transform([d["description"] for d in self.filtered_datasets])
+        self.index_dir = index_dir
+        if index is None:
+            index = self.rebuild_index(force=True) if rebuild else (self._open_index() or self.rebuild_index())
+        self.index = index
+        self.records = self.index.records
+        # Former name, kept for callers; filters are now applied per search, so this holds every dataset
+        self.filtered_datasets = self.records
+        self.dataset_vectors = self.index.matrix
+
+    @property
+    def vectorizer(self):
+        return self.index.vectorizer
+
+    def _pointer_path(self):
+        # Points to the index built from the latest known dataset fingerprint
+        return os.path.join(self.index_dir, f"{DATASET_NAME.replace('/', '__')}.json")
+
+    def _open_index(self):
+        try:
+            with open(self._pointer_path()) as f:
+                return DatasetIndex(os.path.join(self.index_dir, json.load(f)["index"]))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def rebuild_index(self, force=False):
+        """
+        Load the dataset, and unless an index for its fingerprint already exists (or `force`
+        is set), fit a new index over all of its rows. Returns the opened index.
+        """
+        self.datasets = load_dataset(DATASET_NAME)["train"]
+        fingerprint = getattr(self.datasets, "_fingerprint", None) or "unknown"
+        path = os.path.join(self.index_dir, fingerprint)
+        if force or not os.path.exists(os.path.join(path, "meta.json")):
+            DatasetIndex.build(path, self.datasets, fingerprint, {"dataset": DATASET_NAME})
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_pointer = f"{self._pointer_path()}.tmp"
+        with open(tmp_pointer, "w") as f:
+            json.dump({"index": fingerprint}, f)
+        os.replace(tmp_pointer, self._pointer_path())
+        return DatasetIndex(path)
+
+    def _filter_mask(self, min_likes=_DEFAULT, min_downloads=_DEFAULT, min_values=None):
+        """
+        Boolean mask of rows passing the filters, computed from the metadata columns.
+        As before, datasets with missing or zero likes/downloads never pass those filters.
+        `min_values` maps any other numeric column to a minimum value. A filter set to None,
+        or on a column the index does not have, is skipped.
+        """
+        min_likes = self.min_likes if min_likes is _DEFAULT else min_likes
+        min_downloads = self.min_downloads if min_downloads is _DEFAULT else min_downloads
+        mask = np.ones(self.dataset_vectors.shape[0], dtype=bool)
+        for name, minimum in (("likes", min_likes), ("downloads", min_downloads)):
+            column = self.index.columns.get(name)
+            if minimum is not None and column is not None:
+                mask &= (column > 0) & (column >= minimum)
+        for name, minimum in (min_values or {}).items():
+            column = self.index.columns.get(name)
+            if minimum is not None and column is not None:
+                mask &= column >= minimum
+        return mask
+
+    @staticmethod
+    def _top_k(scores, k):
+        """
+        Indices of the k largest entries of each row of `scores`, best first.
+        Uses partial selection (argpartition), so only the k winners are sorted.
+        """
+        k = min(k, scores.shape[1])
+        if k <= 0:
+            return np.empty((scores.shape[0], 0), dtype=np.intp)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1)
+
+    def search(self, query, top_n=10, min_likes=_DEFAULT, min_downloads=_DEFAULT, min_values=None):
+        return [record for record, _ in self.search_many([query], top_n, min_likes, min_downloads, min_values)[0]]
 
-    def _filter_datasets(self):
+    def search_many(self, queries, top_n=10, min_likes=_DEFAULT, min_downloads=_DEFAULT, min_values=None):
+        """
+        Search several queries at once: all queries are vectorized together and scored with a
+        single sparse matrix product, and rows failing the metadata filters are masked out.
+        `min_likes`/`min_downloads` default to the searcher's thresholds; pass None to disable them.
+        Returns, per query, a list of (record, score) pairs, best first.
+        """
+        if not queries:
+            return []
+        query_vectors = self.vectorizer.transform(list(queries))
+        scores = (query_vectors @ self.dataset_vectors.T).toarray()
+        scores[:, ~self._filter_mask(min_likes, min_downloads, min_values)] = -np.inf
+        top = self._top_k(scores, top_n)
         return [
-            d for d in self.datasets 
-            if d['likes'] and d['likes'] >= self.min_likes and d['downloads'] and d['downloads'] >= self.min_downloads
+            [(self.records[i], float(scores[row, i])) for i in top[row] if scores[row, i] != -np.inf]
+            for row in range(len(queries))
         ]
 
-    def search(self, query, top_n=10):
-        query_vector = self.vectorizer.transform([query])
-        scores = linear_kernel(query_vector, self.dataset_vectors).flatten()
-        top_indices = scores.argsort()[-top_n:][::-1]
-        return [self.filtered_datasets[i] for i in top_indices]
+SEMANTIC_SCHOLAR_API_URL = os.getenv("AUTODEV_S2_API_URL", "https://api.semanticscholar.org/graph/v1")
+PAPER_CACHE_PATH = os.getenv("AUTODEV_PAPER_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "autodev", "papers.sqlite"))
+# Semantic Scholar allows about one request per second (shared, or per key when S2_API_KEY is set);
+# keyed clients with a higher quota can raise these
+SEMANTIC_SCHOLAR_RATE = float(os.getenv("AUTODEV_S2_RATE", 1.0))
+SEMANTIC_SCHOLAR_BURST = int(os.getenv("AUTODEV_S2_BURST", 2))
+PAPER_FIELDS = ("title", "abstract", "year", "authors", "venue", "url", "citationCount", "openAccessPdf", "externalIds")
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: refills `rate` tokens per second up to `burst`.
+    acquire() blocks until a token is available.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
 
 class PaperSearcher:
-    def __init__(self):
-        self.scholar = SemanticScholar(retry=False)
+    """
+    Semantic Scholar paper search with a persistent query->results cache and concurrent fan-out.
 
-    def search_papers(self, query, top_n=10):
-        return self.scholar.search_paper(query, limit=top_n, min_citation_count=3, open_access_pdf=True)
+    Results are stored in a SQLite ResponseCache and reused for `cache_ttl` seconds.
+    search_many() issues the uncached queries concurrently; every request first takes a token
+    from a shared bucket (`rate` requests per second, bursts of `burst`). The defaults follow the
+    provider's quota (SEMANTIC_SCHOLAR_RATE), so the limiter rather than 429 retries paces a fan-out.
+    Rate-limited (429), server (5xx) and transport errors are retried with exponential backoff and
+    jitter, honoring a Retry-After header when the server sends one. A query that still fails returns no papers without affecting the others.
+    `api_url` can point at a local stub server for tests and offline runs.
+    """
+    def __init__(self, api_url=SEMANTIC_SCHOLAR_API_URL, api_key=None, cache_path=PAPER_CACHE_PATH,
+                 cache_ttl=7 * 24 * 3600, rate=SEMANTIC_SCHOLAR_RATE, burst=SEMANTIC_SCHOLAR_BURST, max_workers=8,
+                 retries=4, backoff=1.0, timeout=30.0):
+        self.api_url = api_url.rstrip("/")
+        self.api_key = api_key or os.getenv("S2_API_KEY")
+        self.cache = ResponseCache(path=cache_path, max_age=cache_ttl) if cache_path else None
+        self.bucket = TokenBucket(rate, burst)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
 
-class CodeExecutor:
-    @staticmethod
-    def execute(code, timeout=60, max_output_len=1000):
-        output_capture = io.StringIO()
-        sys.stdout = output_capture
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _params(self, query, top_n):
+        return {"query": query, "limit": top_n, "fields": ",".join(PAPER_FIELDS),
+                "minCitationCount": 3, "openAccessPdf": ""}
 
-        def run():
+    def _cache_key(self, params):
+        payload = json.dumps({"url": self.api_url, "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _fetch(self, params):
+        headers = {"x-api-key": self.api_key} if self.api_key else {}
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            self._count("requests")
             try:
-                exec(code, {})
-            except Exception as e:
-                output_capture.write(f"[ERROR]: {str(e)}\n")
-                traceback.print_exc(file=output_capture)
+                response = self.session.get(f"{self.api_url}/paper/search", params=params, headers=headers,
+                                            timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                response = None
+            else:
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    return response.json().get("data") or []
+                if attempt == self.retries:
+                    response.raise_for_status()
+            self._count("retried")
+            time.sleep(self._retry_delay(attempt, response))
+
+    def search_papers(self, query, top_n=10):
+        return self.search_many([query], top_n)[0]
+
+    def search_many(self, queries, top_n=10):
+        """
+        Search several queries at once. Cached results are served directly and the rest are
+        fetched concurrently under the rate limit. Returns one list of paper dicts per query.
+        """
+        results, pending = [None] * len(queries), {}
+        for i, query in enumerate(queries):
+            params = self._params(query, top_n)
+            key = self._cache_key(params)
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                results[i] = json.loads(cached)
+            else:
+                pending.setdefault(key, (params, []))[1].append(i)
+        if pending:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+                futures = {executor.submit(self._fetch, params): key for key, (params, _) in pending.items()}
+                for future, key in futures.items():
+                    try:
+                        papers = future.result()
+                    except Exception as e:
+                        logging.warning(f"Paper search for {pending[key][0]['query']!r} failed: {e}")
+                        self._count("failed")
+                        papers = []
+                        for i in pending[key][1]:
+                            results[i] = papers
+                        continue
+                    if self.cache is not None:
+                        self.cache.put(key, "semanticscholar", json.dumps(papers))
+                    for i in pending[key][1]:
+                        results[i] = papers
+        return results
+
+    def stats(self):
+        with self._lock:
+            stats = {"requests": self.requests, "retries": self.retried, "failed": self.failed}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+PDF_TEXT_CACHE_DIR = os.getenv("AUTODEV_PDF_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "autodev", "pdf_text"))
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _pdf_page_count(path):
+    return len(PdfReader(path).pages)
+
+def _extract_pdf_pages(path, start, stop):
+    """Extract the text of pages [start, stop) of a PDF. Runs in an ingestion worker process."""
+    reader = PdfReader(path)
+    pages = []
+    for number in range(start, stop):
+        try:
+            pages.append((number, reader.pages[number].extract_text() or ""))
+        except Exception as e:
+            pages.append((number, f"[unreadable page: {e}]"))
+    return pages
+
+class PdfIngestor:
+    """
+    Extracts text from PDFs page by page on a process pool.
+
+    iter_pages() yields (path, page_number, text) as pages complete, in no particular order.
+    Extracted text is cached under `cache_dir` by the SHA-256 of the file, so unchanged PDFs
+    are never parsed again. ingest() collects the pages per document and splits them into
+    prompt-sized chunks. `pages_per_task` batches pages so each worker opens the PDF once per batch.
+    """
+    def __init__(self, max_workers=None, cache_dir=PDF_TEXT_CACHE_DIR, pages_per_task=8):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        self.pages_per_task = pages_per_task
+        self.pages = 0
+        self.cached_pages = 0
+        self.failed_documents = 0
+        self.elapsed = 0.0
+
+    def _cache_path(self, digest):
+        return os.path.join(self.cache_dir, f"{digest}.json")
 
+    def _load_cached(self, digest):
         try:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(run)
-                future.result(timeout=timeout)
-        except concurrent.futures.TimeoutError:
-            return "[ERROR]: Execution timed out. Reduce code complexity."
+            with open(self._cache_path(digest)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _store(self, digest, pages):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = f"{self._cache_path(digest)}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(pages, f)
+        os.replace(tmp_path, self._cache_path(digest))
+
+    def iter_pages(self, paths):
+        """
+        Yield (path, page_number, text) for every page of every PDF in `paths`.
+        Cached documents are yielded first, the rest as worker batches complete.
+        A document that cannot be read is logged, counted in `failed_documents` and skipped.
+        """
+        start = time.time()
+        try:
+            pending = {}
+            for path in paths:
+                try:
+                    digest = _file_digest(path)
+                except OSError as e:
+                    self._skip(path, e)
+                    continue
+                cached = self._load_cached(digest)
+                if cached is not None:
+                    for number, text in enumerate(cached):
+                        self.cached_pages += 1
+                        yield path, number, text
+                else:
+                    pending[path] = digest
+            if not pending:
+                return
+            # Plain spawn rather than the shared forkserver, whose preload (torch, sklearn) parsing PDFs does not need
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                        mp_context=multiprocessing.get_context("spawn")) as executor:
+                count_futures = {path: executor.submit(_pdf_page_count, path) for path in pending}
+                futures, documents = {}, {}
+                for path, count_future in count_futures.items():
+                    try:
+                        count = count_future.result()
+                    except Exception as e:
+                        self._skip(path, e)
+                        continue
+                    documents[path] = [None] * count
+                    for first in range(0, count, self.pages_per_task):
+                        future = executor.submit(_extract_pdf_pages, path, first, min(first + self.pages_per_task, count))
+                        futures[future] = path
+                    if count == 0:
+                        self._store(pending[path], documents.pop(path))
+                for future in concurrent.futures.as_completed(futures):
+                    path = futures[future]
+                    if path not in documents:
+                        continue  # an earlier batch of this document failed
+                    try:
+                        batch = future.result()
+                    except Exception as e:
+                        self._skip(path, e)
+                        documents.pop(path)
+                        continue
+                    for number, text in batch:
+                        documents[path][number] = text
+                        self.pages += 1
+                        yield path, number, text
+                    if all(text is not None for text in documents[path]):
+                        self._store(pending[path], documents.pop(path))
+        finally:
+            self.elapsed += time.time() - start
+
+    def _skip(self, path, error):
+        logging.warning(f"Skipping unreadable PDF {path}: {error}")
+        self.failed_documents += 1
+
+    def ingest(self, paths, max_tokens=800, overlap=100, on_page=None):
+        """
+        Extract every PDF in `paths` and return its text as chunks of at most `max_tokens`
+        tokens: a list of {"source", "chunk", "text"} dicts in document order.
+        `on_page(path, page_number, text)` is called as each page arrives.
+        """
+        documents = {path: {} for path in paths}
+        for path, number, text in self.iter_pages(paths):
+            documents[path][number] = text
+            if on_page is not None:
+                on_page(path, number, text)
+        chunks = []
+        for path, pages in documents.items():
+            text = "\n\n".join(pages[number] for number in sorted(pages))
+            for i, chunk in enumerate(chunk_text(text, max_tokens=max_tokens, overlap=overlap)):
+                chunks.append({"source": path, "chunk": i, "text": chunk})
+        return chunks
+
+    def stats(self):
+        total = self.pages + self.cached_pages
+        return {
+            "pages": total,
+            "parsed_pages": self.pages,
+            "cached_pages": self.cached_pages,
+            "failed_documents": self.failed_documents,
+            "seconds": self.elapsed,
+            "pages_per_second": total / self.elapsed if self.elapsed else 0.0,
+        }
+
+# Modules imported once by the forkserver so every worker starts with them loaded.
+# Missing modules are skipped by multiprocessing.
+DEFAULT_PRELOAD = ["numpy", "sklearn", "torch"]
+
+# Modules the process-wide forkserver was started with, None until it is started
+_FORKSERVER_PRELOAD = None
+_FORKSERVER_LOCK = threading.Lock()
+
+def _process_context(preload):
+    """
+    Return the multiprocessing context for worker processes: forkserver where available, else spawn.
+    There is one forkserver per process and it imports its preload list only when it starts, so the
+    first caller starts it immediately with `preload`; a later caller asking for modules it was not
+    started with gets a warning, since its workers will import them cold.
+    """
+    global _FORKSERVER_PRELOAD
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    from multiprocessing import forkserver
+    ctx = multiprocessing.get_context("forkserver")
+    with _FORKSERVER_LOCK:
+        if _FORKSERVER_PRELOAD is None:
+            ctx.set_forkserver_preload(list(preload))
+            forkserver.ensure_running()
+            _FORKSERVER_PRELOAD = list(preload)
+        elif not set(preload) <= set(_FORKSERVER_PRELOAD):
+            logging.warning(f"Forkserver already running with preload {_FORKSERVER_PRELOAD}; "
+                            f"workers will import {sorted(set(preload) - set(_FORKSERVER_PRELOAD))} on their own")
+    return ctx
+
+class BoundedOutput(io.TextIOBase):
+    """
+    Fixed-memory text sink that keeps the first `head_len` and the last `tail_len` characters.
+    Everything in between is counted in `dropped` but not stored, so a snippet printing in a
+    loop cannot exhaust memory and the final traceback is still visible. `on_write`, if given,
+    receives every chunk as it is written.
+    """
+    def __init__(self, head_len=500, tail_len=500, on_write=None):
+        self.head_len = head_len
+        self.tail_len = tail_len
+        self.on_write = on_write
+        self.dropped = 0
+        self._head = []
+        self._head_size = 0
+        self._tail = collections.deque()
+        self._tail_size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        written = len(text)
+        if self.on_write is not None:
+            self.on_write(text)
+        if self._head_size < self.head_len:
+            part = text[:self.head_len - self._head_size]
+            self._head.append(part)
+            self._head_size += len(part)
+            text = text[len(part):]
+        if text and self.tail_len > 0:
+            self._tail.append(text)
+            self._tail_size += len(text)
+            # Ring buffer: discard the oldest tail text beyond tail_len
+            while self._tail_size > self.tail_len:
+                excess = self._tail_size - self.tail_len
+                oldest = self._tail[0]
+                if len(oldest) <= excess:
+                    self._tail.popleft()
+                    self._tail_size -= len(oldest)
+                    self.dropped += len(oldest)
+                else:
+                    self._tail[0] = oldest[excess:]
+                    self._tail_size -= excess
+                    self.dropped += excess
+        elif text:
+            self.dropped += len(text)
+        return written
+
+    def getvalue(self):
+        head, tail = "".join(self._head), "".join(self._tail)
+        if self.dropped:
+            return f"{head}\n... [{self.dropped} characters dropped] ...\n{tail}"
+        return head + tail
+
+class _OutputStreamer:
+    """Batches worker output into ("output", text) messages so printing in a loop does not flood the pipe."""
+    def __init__(self, conn, max_chars=4096, max_delay=0.05):
+        self.conn = conn
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._pending = []
+        self._size = 0
+        self._last_send = time.time()
+
+    def __call__(self, text):
+        self._pending.append(text)
+        self._size += len(text)
+        if self._size >= self.max_chars or time.time() - self._last_send >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self.conn.send(("output", "".join(self._pending)))
+            self._pending, self._size = [], 0
+        self._last_send = time.time()
+
+def _set_job_limits(cpu_seconds, memory_bytes):
+    """
+    Apply per-job soft rlimits inside a worker and return the previous limits.
+    Both limits are relative to what the warm worker already uses, so a long-lived
+    worker with preloaded libraries still gets the full budget for every job.
+    """
+    import resource
+    previous = {}
+    if cpu_seconds is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft, hard = previous[resource.RLIMIT_CPU] = resource.getrlimit(resource.RLIMIT_CPU)
+        limit = int(usage.ru_utime + usage.ru_stime + cpu_seconds) + 1
+        resource.setrlimit(resource.RLIMIT_CPU, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    if memory_bytes is not None and os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            address_space = int(f.read().split()[0]) * resource.getpagesize()
+        soft, hard = previous[resource.RLIMIT_AS] = resource.getrlimit(resource.RLIMIT_AS)
+        limit = address_space + memory_bytes
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    return previous
+
+def _restore_job_limits(previous):
+    import resource
+    for which, limits in previous.items():
+        resource.setrlimit(which, limits)
+
+def _worker_main(conn):
+    """
+    Worker loop: receive a job, execute it with its own output capture and limits, send the output back.
+    Each job gets fresh globals, and the working directory, environment, sys.path and sys.argv are
+    restored after it. Changes to imported modules persist until the worker is recycled.
+    """
+    cwd, environ, path, argv = os.getcwd(), dict(os.environ), list(sys.path), list(sys.argv)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        streamer = _OutputStreamer(conn) if job["stream"] else None
+        output_capture = BoundedOutput(job["head_len"], job["tail_len"], on_write=streamer)
+        sys.stdout = sys.stderr = output_capture
+        previous = {}
+        try:
+            previous = _set_job_limits(job["cpu_seconds"], job["memory_bytes"])
+            exec(job["code"], {"__name__": "__main__"})
+        except BaseException as e:
+            output_capture.write(f"[ERROR]: {str(e) or type(e).__name__}\n")
+            traceback.print_exc(file=output_capture)
         finally:
-            sys.stdout = sys.__stdout__
+            _restore_job_limits(previous)
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(environ)
+            sys.path[:] = path
+            sys.argv[:] = argv
+        if streamer is not None:
+            streamer.flush()
+        conn.send(("done", output_capture.getvalue()))
+
+class _Worker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        """Ask an idle worker to exit, killing it if it does not."""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+class ExecutorPool:
+    """
+    Pool of warm worker processes that execute code snippets.
+
+    Workers are forked from a forkserver that has already imported `preload`, so a new
+    worker starts with numpy/sklearn/torch loaded. The forkserver is shared by the whole process
+    and keeps the preload of whoever started it first (see _process_context()). Each job runs in
+    its own process with its own stdout, optional CPU-time and memory rlimits, and is killed (and
+    its worker replaced) when it exceeds `timeout`. Workers are recycled after `max_jobs_per_worker`
+    jobs so module state changed by one snippet does not leak into later ones indefinitely.
+    """
+    def __init__(self, workers=None, preload=None, cpu_seconds=None, memory_bytes=None, max_jobs_per_worker=25):
+        self._ctx = _process_context(DEFAULT_PRELOAD if preload is None else list(preload))
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.size = workers or os.cpu_count() or 1
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._stats = {"jobs": 0, "timeouts": 0, "crashes": 0, "aborted": 0, "recycled": 0, "busy_seconds": 0.0}
+        self._first_start = None
+        self._last_finish = None
+        for _ in range(self.size):
+            self._idle.put(_Worker(self._ctx))
+
+    def execute(self, code, timeout=60, max_output_len=1000, head_len=None, tail_len=None, on_output=None):
+        """
+        Run `code` in a worker and return its captured output.
+        At most `max_output_len` characters are kept: the first `head_len` (default half) and
+        the last `tail_len` (default the rest), with a note of how much was dropped in between.
+        `on_output(text)` is called with output chunks while the code is still running.
+        """
+        head_len = max_output_len // 2 if head_len is None else head_len
+        tail_len = max_output_len - head_len if tail_len is None else tail_len
+        worker = self._idle.get()
+        start = time.time()
+        deadline = start + timeout
+        # Anything but a clean "done" (on_output raising, KeyboardInterrupt, ...) leaves the worker
+        # busy with unread messages, so it must not go back to the idle queue
+        outcome = "aborted"
+        try:
+            worker.conn.send({"code": code, "head_len": head_len, "tail_len": tail_len, "stream": on_output is not None,
+                              "cpu_seconds": self.cpu_seconds, "memory_bytes": self.memory_bytes})
+            while True:
+                if not worker.conn.poll(max(deadline - time.time(), 0)):
+                    outcome = "timeouts"
+                    output = "[ERROR]: Execution timed out. Reduce code complexity."
+                    break
+                kind, payload = worker.conn.recv()
+                if kind == "output":
+                    on_output(payload)
+                    continue
+                output = payload
+                outcome = "jobs"
+                break
+        except (EOFError, OSError):
+            outcome = "crashes"
+            worker.process.join(1)
+            output = f"[ERROR]: Execution process died (exit code {worker.process.exitcode})."
+        finally:
+            worker.jobs += 1
+            recycled = outcome == "jobs" and self.max_jobs_per_worker and worker.jobs >= self.max_jobs_per_worker
+            if outcome != "jobs":
+                # Hard-kill runaway, dead or abandoned workers and start a fresh one in their place
+                worker.kill()
+                worker = _Worker(self._ctx)
+            elif recycled:
+                worker.stop()
+                worker = _Worker(self._ctx)
+            self._idle.put(worker)
+            finish = time.time()
+            with self._lock:
+                self._stats["jobs"] += 1
+                if outcome != "jobs":
+                    self._stats[outcome] += 1
+                if recycled:
+                    self._stats["recycled"] += 1
+                self._stats["busy_seconds"] += finish - start
+                self._first_start = start if self._first_start is None else min(self._first_start, start)
+                self._last_finish = finish if self._last_finish is None else max(self._last_finish, finish)
+        return output
+
+    def execute_many(self, codes, timeout=60, max_output_len=1000, head_len=None, tail_len=None):
+        """
+        Execute several snippets in parallel across the workers; results keep the input order.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.size) as executor:
+            return list(executor.map(lambda code: self.execute(code, timeout, max_output_len, head_len, tail_len), codes))
+
+    def stats(self):
+        """
+        Return job counters and throughput (jobs per second of wall time while jobs were running).
+        """
+        with self._lock:
+            stats = dict(self._stats, workers=self.size)
+            wall = (self._last_finish - self._first_start) if self._first_start is not None else 0.0
+        stats["throughput"] = stats["jobs"] / wall if wall > 0 else 0.0
+        stats["utilization"] = stats["busy_seconds"] / (wall * self.size) if wall > 0 else 0.0
+        return stats
+
+    def shutdown(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            worker.stop()
+
+class CodeExecutor:
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, workers=None, preload=None, cpu_seconds=None, memory_bytes=None, max_jobs_per_worker=25):
+        """
+        Replace the shared worker pool, e.g. to change its size, preloaded modules, per-job limits or recycling.
+        """
+        with cls._pool_lock:
+            if cls._pool is not None:
+                cls._pool.shutdown()
+            cls._pool = ExecutorPool(workers=workers, preload=preload, cpu_seconds=cpu_seconds, memory_bytes=memory_bytes,
+                                     max_jobs_per_worker=max_jobs_per_worker)
+            return cls._pool
+
+    @classmethod
+    def pool(cls):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = ExecutorPool()
+                atexit.register(cls._pool.shutdown)
+            return cls._pool
+
+    @classmethod
+    def execute(cls, code, timeout=60, max_output_len=1000, head_len=None, tail_len=None, on_output=None):
+        return cls.pool().execute(code, timeout=timeout, max_output_len=max_output_len,
+                                  head_len=head_len, tail_len=tail_len, on_output=on_output)
+
+    @classmethod
+    def execute_many(cls, codes, timeout=60, max_output_len=1000, head_len=None, tail_len=None):
+        return cls.pool().execute_many(codes, timeout=timeout, max_output_len=max_output_len,
+                                       head_len=head_len, tail_len=tail_len)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the research tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild-dataset-index", help="Reload the dataset and refit the DatasetSearcher index.")
+    rebuild.add_argument('--index-dir', type=str, default=DATASET_INDEX_DIR)
+    return parser.parse_args()
 
-        return output_capture.getvalue()[:max_output_len]
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.command == "rebuild-dataset-index":
+        start = time.time()
+        index = DatasetSearcher(index_dir=args.index_dir, rebuild=True).index
+        print(f"Rebuilt dataset index {index.path} ({index.meta['shape'][0]} datasets) in {time.time() - start:.2f} seconds")
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextlib
+import contextvars
+
+# Span kinds from the outermost to the innermost level
+SPAN_KINDS = ("workflow", "phase", "subtask", "agent", "llm", "attempt")
+
+_CURRENT_SPAN = contextvars.ContextVar("autodev_span", default=None)
+
+
+class Span:
+    """
+    One timed operation. `attributes` carries what was measured (tokens, retries, queue wait, ...).
+    """
+    def __init__(self, tracer, name, kind, parent=None, attributes=None):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self.attributes = dict(attributes or {})
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, amount=1):
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+
+    def finish(self, error=None):
+        if self.end is None:
+            self.end = time.time()
+            if error is not None:
+                self.error = f"{type(error).__name__}: {error}"
+            self.tracer._record(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "end": self.end,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Collects finished spans in memory. The current span is a context variable, so nesting follows
+    the call stack, asyncio tasks, and thread pools that run work in a copied context.
+    """
+    def __init__(self, max_spans=100000):
+        self.max_spans = max_spans
+        self.spans = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def _record(self, span):
+        with self._lock:
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+            else:
+                self.dropped += 1
+
+    def start_span(self, name, kind, parent=None, **attributes):
+        """
+        Start a span without making it current; call finish() on it. Used for spans that do
+        not follow one block of code (a phase spanning several threads, a streamed answer).
+        By default the parent is the current span.
+        """
+        return Span(self, name, kind, parent if parent is not None else _CURRENT_SPAN.get(), attributes)
+
+    @contextlib.contextmanager
+    def span(self, name, kind, parent=None, **attributes):
+        """Run the block as a child span of `parent` (default: the current span)."""
+        span = self.start_span(name, kind, parent, **attributes)
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.finish(error=e)
+            raise
+        finally:
+            _CURRENT_SPAN.reset(token)
+            span.finish()
+
+    @contextlib.contextmanager
+    def use_span(self, span):
+        """Make an already started span current for the block."""
+        token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        finally:
+            _CURRENT_SPAN.reset(token)
+
+    def finished(self, kind=None):
+        with self._lock:
+            spans = list(self.spans)
+        return [span for span in spans if kind is None or span.kind == kind]
+
+    def descendants(self, span, kind=None):
+        """Return the finished spans below `span`, optionally only those of `kind`."""
+        spans = self.finished()
+        children = {}
+        for candidate in spans:
+            children.setdefault(candidate.parent_id, []).append(candidate)
+        found, stack = [], [span.span_id]
+        while stack:
+            for child in children.get(stack.pop(), []):
+                found.append(child)
+                stack.append(child.span_id)
+        return [child for child in found if kind is None or child.kind == kind]
+
+    def slowest(self, n=10, kind=None):
+        return sorted(self.finished(kind), key=lambda span: span.duration, reverse=True)[:n]
+
+    def summary(self, n=10):
+        """Return a text report of the `n` slowest spans."""
+        lines = [f"Slowest {n} spans:"]
+        for span in self.slowest(n):
+            details = ", ".join(f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                                for key, value in sorted(span.attributes.items()))
+            lines.append(f"  {span.duration:8.3f}s  {span.kind:<8} {span.name}" + (f"  ({details})" if details else "")
+                         + (f"  [{span.error}]" if span.error else ""))
+        return "\n".join(lines)
+
+    def export_jsonl(self, path):
+        """Write every finished span as one JSON object per line."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            for span in self.finished():
+                f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    def prometheus_text(self):
+        """
+        Return span metrics in the Prometheus text exposition format: duration totals and counts per
+        span kind and model, plus token, cache-hit, retry and queue-wait totals of LLM calls.
+        Span names are free-form (subtask text, ...), so they only appear in the JSONL export and
+        never as labels, which keeps the number of series bounded.
+        """
+        durations, llm = {}, {}
+        for span in self.finished():
+            key = (span.kind, span.attributes.get("model", ""))
+            total, count, errors = durations.get(key, (0.0, 0, 0))
+            durations[key] = (total + span.duration, count + 1, errors + int(span.error is not None))
+            if span.kind == "llm":
+                model = span.attributes.get("model", span.name)
+                entry = llm.setdefault(model, {"tokens_in": 0, "tokens_out": 0, "cached_tokens_in": 0,
+                                               "cache_hits": 0, "retries": 0, "queue_wait_seconds": 0.0})
+                for field in entry:
+                    entry[field] += span.attributes.get(field, 0) or 0
+
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+        lines = [
+            "# HELP autodev_span_duration_seconds Time spent in spans.",
+            "# TYPE autodev_span_duration_seconds summary",
+        ]
+        for (kind, model), (total, count, _) in sorted(durations.items()):
+            labels = f'kind="{label(kind)}",model="{label(model)}"'
+            lines.append(f"autodev_span_duration_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"autodev_span_duration_seconds_count{{{labels}}} {count}")
+        lines += ["# HELP autodev_span_errors_total Spans that ended with an exception.",
+                  "# TYPE autodev_span_errors_total counter"]
+        for (kind, model), (_, _, errors) in sorted(durations.items()):
+            lines.append(f'autodev_span_errors_total{{kind="{label(kind)}",model="{label(model)}"}} {errors}')
+        for field in ("tokens_in", "tokens_out", "cached_tokens_in", "cache_hits", "retries", "queue_wait_seconds"):
+            metric = f"autodev_llm_{field}_total"
+            lines += [f"# HELP {metric} Sum of {field.replace('_', ' ')} over LLM calls.", f"# TYPE {metric} counter"]
+            for model, entry in sorted(llm.items()):
+                lines.append(f'{metric}{{model="{label(model)}"}} {entry[field]}')
+        return "\n".join(lines) + "\n"
+
+    def export_prometheus(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self.dropped = 0
+
+
+TRACER = Tracer()
+
+
+def current_span():
+    return _CURRENT_SPAN.get()
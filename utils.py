@@ -1,6 +1,13 @@
 import os
 import re
+import json
 import shutil
+import hashlib
+import threading
+import tempfile
+import functools
+import collections
+import concurrent.futures
 import tiktoken
 import subprocess
 import io
@@ -18,38 +25,198 @@ def suppress_stdout():
         finally:
             sys.stdout = old_stdout
 
-def compile_latex(latex_code, compile=True, output_filename="output.pdf", timeout=30):
-    latex_code = latex_code.replace(
-    r"\documentclass{article}",
-    "\\documentclass{article}\n\\usepackage{amsmath, amssymb, graphicx, hyperref, xcolor, algorithm, algpseudocode}"
-)
-    dir_path = "research_dir/tex"
-    tex_file_path = os.path.join(dir_path, "temp.tex")
-    
-    with open(tex_file_path, "w") as f:
-        f.write(latex_code)
+LATEX_CACHE_DIR = os.getenv("AUTODEV_LATEX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "autodev", "latex"))
+LATEX_CACHE_MAX_BYTES = int(os.getenv("AUTODEV_LATEX_CACHE_BYTES", 256 * 1024 * 1024))
+# Where compile=False writes the source when no output_dir is given
+LATEX_SOURCE_DIR = "research_dir/tex"
+LATEX_PREAMBLE = "\\documentclass{article}\n\\usepackage{amsmath, amssymb, graphicx, hyperref, xcolor, algorithm, algpseudocode}"
 
+# Striped locks by source hash, so identical sources compiled concurrently run pdflatex once
+_LATEX_LOCKS = [threading.Lock() for _ in range(64)]
+# Serialises eviction across the whole cache directory
+_LATEX_EVICT_LOCK = threading.Lock()
+
+def _latex_lock(key):
+    return _LATEX_LOCKS[int(key[:8], 16) % len(_LATEX_LOCKS)]
+
+def _evict_latex_cache(cache_dir, max_bytes, keep=None):
+    """
+    Delete the least recently used cached PDFs until the cache fits in `max_bytes`.
+    `keep` (a PDF path) is never evicted; files removed by another process are skipped.
+    """
+    with _LATEX_EVICT_LOCK:
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if not name.endswith(".pdf") or path == keep:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            try:
+                total += os.stat(keep).st_size
+            except FileNotFoundError:
+                pass
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def _deliver_pdf(pdf_path, output_dir, output_filename):
+    """Copy a cached PDF to `output_dir/output_filename` if requested and return where the PDF is."""
+    if output_dir is None:
+        return pdf_path
+    os.makedirs(output_dir, exist_ok=True)
+    target = os.path.join(output_dir, output_filename)
+    shutil.copyfile(pdf_path, target)
+    return target
+
+def latex_cache_path(latex_code, cache_dir=LATEX_CACHE_DIR):
+    """Return the path of the cached PDF for `latex_code` (which may not exist yet)."""
+    latex_code = latex_code.replace(r"\documentclass{article}", LATEX_PREAMBLE)
+    return os.path.join(cache_dir, hashlib.sha256(latex_code.encode("utf-8")).hexdigest() + ".pdf")
+
+def compile_latex(latex_code, compile=True, output_filename="output.pdf", timeout=30, output_dir=None,
+                  cache_dir=LATEX_CACHE_DIR, max_cache_bytes=LATEX_CACHE_MAX_BYTES):
+    """
+    Compile `latex_code` with pdflatex in a private scratch directory named after the
+    SHA-256 of the source, so concurrent compiles never share files.
+    Successful builds are kept in `cache_dir` (least recently used PDFs are evicted beyond
+    `max_cache_bytes`) and identical sources are served from there without running pdflatex.
+    If `output_dir` is given the PDF is also copied to `output_dir/output_filename`.
+    Returns "Compilation successful: <pdf path>" (the copy in `output_dir`, else the cached PDF)
+    or an "[ERROR]: ..." message.
+    With `compile=False` the source is only written to `output_dir` (default LATEX_SOURCE_DIR) as temp.tex.
+    """
+    latex_code = latex_code.replace(r"\documentclass{article}", LATEX_PREAMBLE)
     if not compile:
+        source_dir = output_dir or LATEX_SOURCE_DIR
+        os.makedirs(source_dir, exist_ok=True)
+        with open(os.path.join(source_dir, "temp.tex"), "w") as f:
+            f.write(latex_code)
         return "Compilation successful"
+    key = hashlib.sha256(latex_code.encode("utf-8")).hexdigest()
+    pdf_path = os.path.join(cache_dir, f"{key}.pdf")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with _latex_lock(key):
+        try:
+            os.utime(pdf_path)  # mark as recently used
+            return f"Compilation successful (cached): {_deliver_pdf(pdf_path, output_dir, output_filename)}"
+        except FileNotFoundError:
+            pass  # not cached yet, or evicted by a concurrent compile
 
+        scratch_dir = tempfile.mkdtemp(prefix=f"{key[:16]}-", dir=cache_dir)
+        try:
+            with open(os.path.join(scratch_dir, "temp.tex"), "w") as f:
+                f.write(latex_code)
+            try:
+                result = subprocess.run(
+                    ["pdflatex", "-interaction=nonstopmode", "temp.tex"],
+                    check=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    timeout=timeout,
+                    cwd=scratch_dir
+                )
+            except subprocess.TimeoutExpired:
+                return "[ERROR]: Compilation timed out."
+            except subprocess.CalledProcessError as e:
+                return f"[ERROR]: Compilation failed: {e.stderr.decode('utf-8')}"
+            if not os.path.exists(os.path.join(scratch_dir, "temp.pdf")):
+                return f"[ERROR]: Compilation produced no PDF: {result.stdout.decode('utf-8')[-2000:]}"
+            os.replace(os.path.join(scratch_dir, "temp.pdf"), pdf_path)
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        target = _deliver_pdf(pdf_path, output_dir, output_filename)
+
+    _evict_latex_cache(cache_dir, max_cache_bytes, keep=pdf_path)
+    return f"Compilation successful: {target}"
+
+def compile_latex_many(sources, max_workers=4, **kwargs):
+    """
+    Compile several LaTeX sources concurrently on a bounded thread pool (each compile is a
+    pdflatex subprocess). Returns the compile_latex() results in the order of `sources`.
+    """
+    if not sources:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(sources))) as executor:
+        return list(executor.map(lambda source: compile_latex(source, **kwargs), sources))
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o"):
+    """
+    Return the tiktoken encoding for `model`, loading it once per model.
+    Models tiktoken does not know (e.g. Claude) fall back to o200k_base.
+    """
     try:
-        result = subprocess.run(
-            ["pdflatex", "-interaction=nonstopmode", "temp.tex"],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            timeout=timeout,
-            cwd=dir_path
-        )
-        return f"Compilation successful: {result.stdout.decode('utf-8')}"
-    except subprocess.TimeoutExpired:
-        return "[ERROR]: Compilation timed out."
-    except subprocess.CalledProcessError as e:
-        return f"[ERROR]: Compilation failed: {e.stderr.decode('utf-8')}"
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+# Token counts per (model, content hash), shared by every ContextWindow and clip_tokens call
+_TOKEN_COUNTS = collections.OrderedDict()
+_TOKEN_COUNTS_LOCK = threading.Lock()
+_TOKEN_COUNTS_MAX = 8192
+
+def cached_token_count(content, model="gpt-4o"):
+    """
+    Return the number of tokens in `content`, tokenizing each distinct content only once.
+    """
+    key = (model, hashlib.sha1(content.encode("utf-8")).digest())
+    with _TOKEN_COUNTS_LOCK:
+        count = _TOKEN_COUNTS.get(key)
+        if count is not None:
+            _TOKEN_COUNTS.move_to_end(key)
+            return count
+    count = len(get_encoding(model).encode(content))
+    with _TOKEN_COUNTS_LOCK:
+        _TOKEN_COUNTS[key] = count
+        if len(_TOKEN_COUNTS) > _TOKEN_COUNTS_MAX:
+            _TOKEN_COUNTS.popitem(last=False)
+    return count
 
 def count_tokens(messages, model="gpt-4o"):
-    enc = tiktoken.encoding_for_model(model)
-    return sum([len(enc.encode(m["content"])) for m in messages])
+    return sum([cached_token_count(m["content"], model) for m in messages])
+
+def strip_stream(chunks):
+    """
+    Streaming equivalent of str.strip(): drops leading whitespace and holds back
+    trailing whitespace until more text arrives, so the concatenated output
+    equals "".join(chunks).strip().
+    """
+    started, pending = False, ""
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+        body = chunk.rstrip()
+        if body:
+            yield pending + body
+            pending = chunk[len(body):]
+        else:
+            pending += chunk
+
+def chunk_text(text, max_tokens=800, overlap=100, model="gpt-4o"):
+    """
+    Split `text` into pieces of at most `max_tokens` tokens, each starting `overlap`
+    tokens before the end of the previous one so no sentence is lost at a boundary.
+    """
+    enc = get_encoding(model)
+    tokens = enc.encode(text)
+    step = max(max_tokens - overlap, 1)
+    return [enc.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), step)
+            if i == 0 or i + overlap < len(tokens)]
 
 def remove_figures():
     for _file in os.listdir("."):
@@ -65,14 +232,111 @@ def save_to_file(location, filename, data):
     with open(filepath, 'w') as f:
         f.write(data)
 
+class ContextWindow:
+    """
+    Message history with a running token total and role-preserving clipping.
+
+    Token counts are cached per message (by content hash) and the total is updated
+    as messages are appended, so each turn only tokenizes the new message.
+    clip() keeps system messages (if `keep_system`) and the `keep_last` most recent
+    messages, and drops the oldest messages in between until the history fits in
+    `max_tokens`. If the protected messages alone are still too long, the oldest
+    of them are truncated to their last tokens, system messages last.
+    Clipping is incremental: the history only grows, so messages dropped by one clip()
+    stay dropped and later calls only look at the messages after them.
+    """
+    def __init__(self, model="gpt-4o", max_tokens=100000, keep_system=True, keep_last=2, messages=None):
+        self.model = model
+        self.max_tokens = max_tokens
+        self.keep_system = keep_system
+        self.keep_last = keep_last
+        self.messages = []
+        self.token_counts = []
+        self.total_tokens = 0
+        # Every unpinned message before _clip_start has been dropped; _clip_pinned lists the pinned ones kept
+        self._clip_start = 0
+        self._clip_pinned = []
+        self._dropped_tokens = 0
+        self.extend(messages or [])
+
+    def append(self, message):
+        count = cached_token_count(message["content"], self.model)
+        self.messages.append(message)
+        self.token_counts.append(count)
+        self.total_tokens += count
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def fits(self):
+        return self.total_tokens <= self.max_tokens
+
+    def _is_pinned(self, i):
+        return self.keep_system and self.messages[i]["role"] == "system"
+
+    def clip(self):
+        """
+        Return a list of messages that fits in `max_tokens`, in their original order.
+        """
+        if self.fits():
+            return list(self.messages)
+        # The `keep_last` most recent unpinned messages start at latest_start
+        latest_start, latest = len(self.messages), 0
+        while latest_start > self._clip_start and latest < self.keep_last:
+            latest_start -= 1
+            latest += not self._is_pinned(latest_start)
+
+        # Drop the oldest unprotected turns first, continuing where the previous call stopped
+        total = self.total_tokens - self._dropped_tokens
+        while total > self.max_tokens and self._clip_start < latest_start:
+            i = self._clip_start
+            if self._is_pinned(i):
+                self._clip_pinned.append(i)
+            else:
+                total -= self.token_counts[i]
+                self._dropped_tokens += self.token_counts[i]
+            self._clip_start += 1
+
+        kept = self._clip_pinned + list(range(self._clip_start, len(self.messages)))
+        clipped = [self.messages[i] for i in kept]
+        if total > self.max_tokens:
+            # Still too long: keep only the tail of the oldest messages, system messages last
+            enc = get_encoding(self.model)
+            order = sorted(range(len(kept)), key=lambda position: (self.messages[kept[position]]["role"] == "system", position))
+            for position in order:
+                if total <= self.max_tokens:
+                    break
+                count = self.token_counts[kept[position]]
+                budget = max(count - (total - self.max_tokens), 0)
+                total -= count - budget
+                message = clipped[position]
+                clipped[position] = dict(message, content=enc.decode(enc.encode(message["content"])[-budget:])) if budget else None
+            clipped = [message for message in clipped if message is not None]
+        return clipped
+
 def clip_tokens(messages, model="gpt-4o", max_tokens=100000):
-    enc = tiktoken.encoding_for_model(model)
-    total_tokens = sum([len(enc.encode(m["content"])) for m in messages])
-    if total_tokens <= max_tokens:
-        return messages
-    clipped_tokens = enc.encode(" ".join(m["content"] for m in messages))[-max_tokens:]
-    clipped_messages = [{"role": m["role"], "content": enc.decode(clipped_tokens)} for m in messages]
-    return clipped_messages
+    """
+    Clip `messages` to at most `max_tokens`, keeping system messages and the latest
+    turns and dropping the oldest turns in between. Roles are preserved.
+    """
+    return ContextWindow(model=model, max_tokens=max_tokens, messages=messages).clip()
+
+def extract_json_between_markers(llm_output):
+    """
+    Return the first JSON object in `llm_output`, preferring ```json fenced blocks,
+    or None if no block parses.
+    """
+    blocks = re.findall(r"```json(.*?)```", llm_output, re.DOTALL)
+    if not blocks:
+        blocks = re.findall(r"\{.*\}", llm_output, re.DOTALL)
+    for block in blocks:
+        try:
+            # Drop control characters models sometimes emit inside strings
+            return json.loads(re.sub(r"[\x00-\x1F\x7F]", "", block.strip()))
+        except json.JSONDecodeError:
+            continue
+    return None
 
 def extract_prompt(text, word):
     pattern = rf"```{word}(.*?)```"